@@ -1,12 +1,25 @@
 """Module to assemble families from ttfs and diff families"""
 import os
 import re
+import shutil
+import tempfile
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+from diffenator import __version__ as DIFFENATOR_VERSION
 from diffenator.font import DFont
 from diffenator.diff import DiffFonts
 from diffenator.dump import dump_glyphs
+from fontTools.ttLib import TTFont
 from gfregression import downloadfonts
+from gfregression.cache import diff_cache_key, file_sha256
+from gfregression.serialise import serialise_diff
+from gfregression import vectorised
+from gfregression import incremental
+from gfregression import variations
+from gfregression import raster
+from gfregression.udhr import udhr_index
+from gfregression.timing import timed
 import json
 
 current_dir = os.path.dirname(__file__)
@@ -41,6 +54,32 @@ GF_WIDTHS = [
     "UltraExpanded",
 ]
 
+# fontdiffenator categories diffed by diff_families
+DIFF_CATEGORIES = set(['glyphs', 'kerns', 'marks', 'names', 'mkmks', 'metrics'])
+# Part of the diff cache key. Bump it whenever a change to gfregression
+# alters the diffs of the same fonts, so cached diffs made by the previous
+# code aren't reused.
+DIFF_FORMAT_VERSION = 1
+# Categories which gfregression diffs itself, see vectorised.py
+VECTORISED_DIFFS = {
+    'glyphs': vectorised.diff_glyphs,
+    'metrics': vectorised.diff_metrics,
+}
+# Number of the most changed glyphs drawn in each style's glyph diff image
+RENDER_LIMIT = 256
+# Pixel size of the rendered text sample
+RENDER_TEXT_SIZE = 32
+
+# Sort order of the items of each view which is diffed incrementally, the
+# same as diffenator's, see incremental.py
+INCREMENTAL_VIEW_ORDER = {
+    'glyphs_new': dict(key=lambda i: i['glyph']['name']),
+    'glyphs_missing': dict(key=lambda i: i['glyph']['name']),
+    'glyphs_modified': dict(key=lambda i: abs(i['diff']), reverse=True),
+    'metrics_modified': dict(key=lambda i: i['diff_adv'], reverse=True),
+}
+
+
 def find_closest_substring(string, items):
     for item in sorted(items, key=lambda k: len(k), reverse=True):
         if item.lower() in string.lower():
@@ -73,6 +112,10 @@ class Font:
     """
     Wrapper for a ttf font with GF specific attributes.
 
+    Only the tables needed for the font's styles, axes and @font-face are
+    read when the font is created. The fontdiffenator DFont, which parses
+    every glyph, kern and anchor, is built on first access to font.
+
     Parameters
     ----------
     path: str
@@ -111,7 +154,8 @@ class Font:
     def __init__(self, path, family_name=None, style_name=None):
         self.path = path
         self.filename = os.path.basename(self.path)[:-4]
-        self.font = DFont(self.path)
+        self.ttfont = TTFont(self.path, lazy=True)
+        self._font = None
         self._is_vf = self.is_vf
         if not family_name:
             self.family_name = familyname_from_filename(self.filename)
@@ -128,13 +172,50 @@ class Font:
         elif self._is_vf:
             self._get_vf_styles()
         self.axes = self._get_axes()
+        self._sha256 = None
+        self._lazy_font = None
+        self._glyph_hashes = None
 
     def set_family_name(self, name):
         self.family_name = name
 
+    @property
+    def font(self):
+        """fontdiffenator DFont for the font"""
+        if self._font is None:
+            with timed('parse_font'):
+                self._font = DFont(self.path)
+        return self._font
+
+    @property
+    def lazy_font(self):
+        """fontdiffenator DFont whose glyphs, kerns etc haven't been dumped,
+        see gfregression.incremental"""
+        if self._lazy_font is None:
+            with timed('parse_font'):
+                self._lazy_font = DFont(self.path, lazy=True)
+        return self._lazy_font
+
+    @property
+    def glyph_hashes(self):
+        """{glyph key: hash} of a static font's glyphs, see
+        gfregression.incremental.glyph_hashes"""
+        if self._glyph_hashes is None:
+            font = self._font if self._font is not None else self.lazy_font
+            with timed('glyph_hashes'):
+                self._glyph_hashes = incremental.glyph_hashes(font)
+        return self._glyph_hashes
+
+    @property
+    def sha256(self):
+        """SHA-256 digest of the font file"""
+        if not self._sha256:
+            self._sha256 = file_sha256(self.path)
+        return self._sha256
+
     @property
     def is_vf(self):
-        if 'fvar' in self.font.ttfont:
+        if 'fvar' in self.ttfont:
             return True
         return False
 
@@ -155,7 +236,7 @@ class Font:
                 font-family: %s;
                 font-style: %s;
             """ % (self.path, self.family_name,
-                   'italic' if self.font.ttfont["post"].italicAngle != 0. else "normal")
+                   'italic' if self.ttfont["post"].italicAngle != 0. else "normal")
             if 'wght' in self.axes:
                 try:
                     min_wght = self.USWEIGHT_CLASS_TO_CSS_WEIGHT[self.axes['wght'].minValue]
@@ -198,18 +279,16 @@ class Font:
                 )
 
     def _get_vf_styles(self):
-        instance_names = [
-            self.font.ttfont['name'].getName(i.subfamilyNameID, 3, 1, 1033).toUnicode()
-            for i in self.font.ttfont['fvar'].instances
-        ]
-        for style_name in instance_names:
-            style = FontStyle(style_name, self)
+        for instance in self.ttfont['fvar'].instances:
+            style_name = self.ttfont['name'].getName(
+                instance.subfamilyNameID, 3, 1, 1033).toUnicode()
+            style = FontStyle(style_name, self, instance.coordinates)
             self.styles.append(style)
 
     def _get_axes(self):
         axes = {}
-        if 'fvar' in self.font.ttfont:
-            for axis in self.font.ttfont['fvar'].axes:
+        if 'fvar' in self.ttfont:
+            for axis in self.ttfont['fvar'].axes:
                 axes[axis.axisTag] = axis
         return axes
 
@@ -256,10 +335,13 @@ class FontStyle:
     WEIGHTS = GF_WEIGHTS
     WIDTHS = GF_WIDTHS
 
-    def __init__(self, style, font):
-        """Get GF spec style info from a filename or an fvar instance entry."""
+    def __init__(self, style, font, coordinates=None):
+        """Get GF spec style info from a filename or an fvar instance entry.
+
+        coordinates is the {axis tag: value} location of a VF's instance."""
         self.name = style.replace(" ", "")
         self.font = font
+        self.coordinates = coordinates
 
         self.weight = find_closest_substring(self.name, GF_WEIGHTS)
         self.width = find_closest_substring(self.name, GF_WIDTHS)
@@ -294,6 +376,30 @@ class FontStyle:
             )
 
 
+class LocationStyle(FontStyle):
+    """A location in a VF's designspace which isn't a named instance, see
+    gfregression.variations.grid_locations"""
+
+    def __init__(self, font, coordinates):
+        name = variations.location_name(coordinates, font.styles[0].italic)
+        super(LocationStyle, self).__init__(name, font, coordinates)
+
+    @property
+    def css_class(self):
+        settings = ', '.join('"%s" %s' % (tag, self.coordinates[tag])
+                             for tag in sorted(self.coordinates))
+        return """
+            .%s{
+                font-variation-settings: %s;
+                font-style: %s;
+            }
+        """ % (
+                self.css_name,
+                settings,
+                self.css_style
+            )
+
+
 class Family:
     """Container for Fonts which belong a family"""
     def __init__(self):
@@ -303,10 +409,11 @@ class Family:
 
     def append(self, font_path, family_name=None, style_name=None):
         """append font"""
-        if not family_name and not style_name:
-            font = Font(font_path)
-        else:
-            font = Font(font_path, family_name, style_name)
+        with timed('load_font'):
+            if not family_name and not style_name:
+                font = Font(font_path)
+            else:
+                font = Font(font_path, family_name, style_name)
         if not self.name:
             self.name = font.family_name
         if font.family_name != self.name:
@@ -345,12 +452,17 @@ def family_from_googlefonts(family_name, dst, api_key=None,
     if not api_key:
         api_key = os.environ["GF_API_KEY"]
 
-    googlefonts = downloadfonts.GoogleFonts(api_key)
+    with timed('download'):
+        googlefonts = downloadfonts.GoogleFonts(api_key)
+        if include_width_families:
+            gf_families = googlefonts.width_families(family_name)
+            downloads = googlefonts.download_families(gf_families, dst)
+        else:
+            downloads = [googlefonts.download_family(family_name, dst)]
+
     if include_width_families:
         family = Family()
-        gf_families = googlefonts.width_families(family_name)
-        for width_family in gf_families:
-            fonts = googlefonts.download_family(width_family, dst)
+        for fonts in downloads:
             for path in fonts:
                 filename = os.path.basename(path)[:-4]
                 style_name = stylename_from_filename(filename)
@@ -358,9 +470,7 @@ def family_from_googlefonts(family_name, dst, api_key=None,
                 os.rename(path, uuid_file)
                 family.append(uuid_file, family_name, style_name)
         return family
-
-    fonts = googlefonts.download_family(family_name, dst)
-    return _create_family(fonts, dst)
+    return _create_family(downloads[0], dst)
 
 
 def family_from_github_dir(url, dst):
@@ -385,7 +495,16 @@ def family_from_user_upload(request, dst):
     return _create_family(fonts, dst)
 
 
-def _create_family(paths, dst):
+def family_from_paths(paths, dst, copy=False):
+    """Get a family from fonts which have already been saved to disk e.g
+    fonts which were staged by an upload request.
+
+    The fonts are moved to dst, or copied if copy is True so the family
+    can be created from the same paths again."""
+    return _create_family(paths, dst, copy)
+
+
+def _create_family(paths, dst, copy=False):
     """Create a Family from a list of paths"""
     family = Family()
     for path in paths:
@@ -394,115 +513,694 @@ def _create_family(paths, dst):
         style_name = stylename_from_filename(filename)
         ext = path[-4:]
         uuid_file = os.path.join(dst, str(uuid.uuid4()) + ext)
-        os.rename(path, uuid_file)
+        if copy:
+            shutil.copyfile(path, uuid_file)
+        else:
+            shutil.move(path, uuid_file)
         family.append(uuid_file, family_name, style_name)
     return family
 
 
-def diff_families(family_before, family_after, uuid):
-    """Diff two families which have the same family name.
+class FamilyComparison:
+    """The shared styles of two families and every diff stage between them.
 
-    Uses fontdiffenator.
+    Styles are matched once and the Fonts, along with the DFonts and cmaps
+    they open, are shared by each stage, so an upload's fonts are only
+    parsed once. run() drives the stages as a single pipeline.
 
     Parameters
-    ---------
+    ----------
     family_before: Family
     family_after: Family
-
-    Returns
-    -------
-    reports: list
+    uuid: str
+    vf_grid: int
+        If both families are VFs, also compare each pair of VFs at a grid
+        of vf_grid locations per axis, see
+        gfregression.variations.grid_locations. Named instances are
+        always compared.
+    instances: gfregression.variations.InstanceCache
+        Cache of the VF instances each stage uses. If None, a cache in a
+        temporary directory is made when the first VF is instanced, which
+        close() removes.
     """
-    styles_before = {s.name: s for f in family_before.fonts for s in f.styles}
-    styles_after = {s.name: s for f in family_after.fonts for s in f.styles}
+    def __init__(self, family_before, family_after, uuid, vf_grid=0,
+                 instances=None):
+        self._own_instances = instances is None
+        self._instances = instances
+        self.family_before = family_before
+        self.family_after = family_after
+        self.uuid = uuid
+        self.styles_before = {s.name: s for f in family_before.fonts
+                              for s in f.styles}
+        self.styles_after = {s.name: s for f in family_after.fonts
+                             for s in f.styles}
+        shared_styles = set(self.styles_before) & set(self.styles_after)
+        # In family_before's order, which is the order the app lists them
+        self.shared_styles = [s.name for f in family_before.fonts
+                              for s in f.styles if s.name in shared_styles]
+        if vf_grid:
+            self._add_grid_styles(vf_grid)
+        self._words = None
+        self._pairs = {}
+        self._rasterisers = {}
+        self._pixel_scores = {}
 
-    shared_styles = set(styles_before) & set(styles_after)
-    diffs = []
-    for style in shared_styles:
-        font_a = styles_before[style].font.font
-        font_b = styles_after[style].font.font
-
-        if font_a.is_variable and not font_b.is_variable:
-            font_a.set_variations_from_static(font_b)
-
-        elif not font_a.is_variable and font_b.is_variable:
-            font_b.set_variations_from_static(font_a)
-        # TODO (M Foley) vfs against vfs
-
-        style_diff = DiffFonts(
-            font_a,
-            font_b,
-            settings=dict(
-                to_diff=set(['glyphs', 'kerns', 'marks', 'names', 'mkmks', 'metrics'])
+    @property
+    def instances(self):
+        """The InstanceCache of the comparison's VF instances"""
+        if self._instances is None:
+            self._instances = variations.InstanceCache(
+                tempfile.mkdtemp(prefix='gfregression-instances-'))
+        return self._instances
+
+    def close(self):
+        """Remove the instance cache's directory if the comparison made it"""
+        if self._own_instances and self._instances is not None:
+            shutil.rmtree(self._instances.directory, ignore_errors=True)
+            self._instances = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add_grid_styles(self, steps):
+        """Add a LocationStyle for each grid location of each pair of VFs
+        which share a named instance"""
+        pairs = []
+        for style in self.shared_styles:
+            pair = (self.styles_before[style].font,
+                    self.styles_after[style].font)
+            if pair[0].is_vf and pair[1].is_vf and pair not in pairs:
+                pairs.append(pair)
+        for font_before, font_after in pairs:
+            named = [s.coordinates for s in font_after.styles]
+            for location in variations.grid_locations(
+                    font_before.axes, font_after.axes, steps):
+                if location in named:
+                    continue
+                style_before = LocationStyle(font_before, location)
+                style_after = LocationStyle(font_after, location)
+                if style_before.name in self.styles_before:
+                    continue
+                self.styles_before[style_before.name] = style_before
+                self.styles_after[style_after.name] = style_after
+                self.shared_styles.append(style_before.name)
+
+    @property
+    def words(self):
+        """UDHR words which can be formed with family_before's first font"""
+        if self._words is None:
+            with timed('udhr_words'):
+                self._words = udhr_font_words(self.family_before.fonts[0].ttfont)
+        return self._words
+
+    def run(self, diff_families=True, workers=1, cache=None, previous=None,
+            media_dir=None, on_stage=None):
+        """Run every diff stage.
+
+        Parameters
+        ----------
+        diff_families: bool
+            Diff the shared styles with fontdiffenator
+        workers: int
+        cache: gfregression.cache.DiffCache
+        previous: dict
+            see FamilyComparison.diff_families
+        media_dir: str
+            If supplied, the styles are rendered and their diff images
+            saved in media_dir, see FamilyComparison.render. Otherwise no
+            glyphs are rasterised and modified glyphs are ranked by their
+            area change.
+        on_stage: callable
+            Called with the name of each stage and the fraction of the
+            pipeline which has finished, before the stage starts
+
+        Returns
+        -------
+        (diffs, glyph_hashes, families)
+        """
+        if on_stage is None:
+            on_stage = lambda stage, amount: None
+        diffs = []
+        glyph_hashes = []
+        if diff_families:
+            on_stage('diffing families', 0.2)
+            with timed('diff_families'):
+                diffs += self.diff_families(workers, cache, previous)
+            on_stage('ranking glyphs', 0.6)
+            with timed('rank'):
+                self.rank(diffs, pixels=media_dir is not None)
+            glyph_hashes = self.glyph_hashes()
+        on_stage('dumping glyphs', 0.7)
+        with timed('glyphs_all'):
+            diffs += self.glyphs_all()
+        with timed('text'):
+            diffs += self.text()
+        if media_dir:
+            on_stage('rendering', 0.8)
+            with timed('render'):
+                diffs += self.render(media_dir)
+        return diffs, glyph_hashes, self.families()
+
+    def diff_families(self, workers=1, cache=None, previous=None):
+        """Diff each shared style.
+
+        Uses fontdiffenator.
+
+        Parameters
+        ---------
+        workers: int
+            Number of processes used to diff the shared styles. If greater
+            than 1, each style is diffed in its own process and the fonts
+            are reopened from their paths.
+        cache: gfregression.cache.DiffCache
+            If supplied, styles whose fonts have been diffed before are
+            retrieved from the cache instead of being diffed again.
+        previous: dict
+            Results of a previous upload of the family, used to only rediff
+            the glyphs which have changed since. {style name: {
+                'font_before': sha256 of the previous before font,
+                'hashes': glyph hashes of the previous after font,
+                'diffs': {view: serialised items}}}
+            Styles are only diffed incrementally if their before font is the
+            same as the previous upload's and neither font is a VF.
+
+        Returns
+        -------
+        reports: list
+        """
+        styles_before, styles_after = self.styles_before, self.styles_after
+        uuid = self.uuid
+        shared_styles = sorted(self.shared_styles)
+        style_diffs = {}
+        cache_keys = {}
+        if cache is not None:
+            for style in shared_styles:
+                cache_keys[style] = diff_cache_key(
+                    styles_before[style].font,
+                    styles_after[style].font,
+                    styles_before[style].name,
+                    styles_after[style].name,
+                    DIFF_CATEGORIES,
+                    DIFFENATOR_VERSION,
+                    DIFF_FORMAT_VERSION,
+                    self.locations(style),
+                )
+                cached = cache.get(cache_keys[style])
+                if cached is not None:
+                    for diff in cached:
+                        diff['uuid'] = uuid
+                    style_diffs[style] = cached
+
+        for style in shared_styles:
+            if style in style_diffs or not previous or style not in previous:
+                continue
+            font_before = styles_before[style].font
+            font_after = styles_after[style].font
+            if (font_before.is_vf or font_after.is_vf or
+                    previous[style]['font_before'] != font_before.sha256):
+                continue
+            style_diffs[style] = _diff_style_incremental(
+                font_before,
+                font_after,
+                styles_before[style].name,
+                styles_after[style].name,
+                uuid,
+                previous[style],
+            )
+            if cache is not None:
+                cache.set(cache_keys[style], style_diffs[style])
+
+        to_diff = [s for s in shared_styles if s not in style_diffs]
+        if workers > 1 and len(to_diff) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(*self._style_job(s, from_paths=True))
+                           for s in to_diff]
+                results = [f.result() for f in futures]
+        else:
+            results = [func(*args) for func, *args in
+                       map(self._style_job, to_diff)]
+        for style, diffs in zip(to_diff, results):
+            style_diffs[style] = diffs
+            if cache is not None:
+                cache.set(cache_keys[style], diffs)
+        return [diff for s in shared_styles for diff in style_diffs[s]]
+
+    def _style_job(self, style, from_paths=False):
+        """Return the function, and its arguments, which diffs a style.
+
+        If from_paths is True, the function reopens the fonts from their
+        paths so it can be run in another process."""
+        style_before = self.styles_before[style]
+        style_after = self.styles_after[style]
+        font_before, font_after = style_before.font, style_after.font
+        location_before, location_after = self.locations(style)
+        names = (style_before.name, style_after.name, self.uuid)
+        if from_paths:
+            instances = None
+            if location_before is not None or location_after is not None:
+                instances = (self.instances.directory, self.instances.max_size)
+            return (_diff_style_from_paths, instances, font_before.path,
+                    font_after.path, location_before, location_after) + names
+        return (_diff_style, self.dfont(font_before, location_before),
+                self.dfont(font_after, location_after)) + names
+
+    def locations(self, style):
+        """Return the locations a style's before and after fonts are
+        compared at. A static font's location is None.
+
+        VFs compared against VFs use the coordinates of the style's
+        instance. A VF compared against a static font uses the static
+        font's weight and width."""
+        style_before = self.styles_before[style]
+        style_after = self.styles_after[style]
+        font_before, font_after = style_before.font, style_after.font
+        if font_before.is_vf and font_after.is_vf:
+            return style_before.coordinates, style_after.coordinates
+        if font_before.is_vf:
+            return variations.static_location(
+                font_after.ttfont, font_before.axes), None
+        if font_after.is_vf:
+            return None, variations.static_location(
+                font_before.ttfont, font_after.axes)
+        return None, None
+
+    def dfont(self, font, location):
+        """Return a DFont of a Font at a location, see locations"""
+        if location is None:
+            return font.font
+        return self.instances.font(font.path, location)
+
+    def font_path(self, font, location):
+        """Return the path of a Font's instance at a location, see
+        locations"""
+        if location is None:
+            return font.path
+        return self.instances.path(font.path, location)
+
+    def glyphs_all(self):
+        """Dump every glyph for each font in family_before.
+
+        This diff is useful to see whether family_after can access all the
+        glyphs in family_before
+        """
+        items = []
+        for style in self.shared_styles:
+            font = self.dfont(self.styles_before[style].font,
+                              self.locations(style)[0])
+            with timed('dump_glyphs'):
+                glyphs = dump_glyphs(font)._data
+            all_glyphs = {
+                'uuid': self.uuid,
+                'title': 'Glyph All',
+                'view': 'glyphs_all',
+                'font_before': self.styles_before[style].name,
+                'font_after': self.styles_after[style].name,
+                'items': glyphs,
+            }
+            items.append(all_glyphs)
+        with timed('serialise'):
+            return list(map(serialise_diff, items))
+
+    def glyph_hashes(self):
+        """Hash the glyphs of each static font in family_after.
+
+        The hashes are used by diff_families to rediff only the glyphs which
+        have changed when the family is uploaded again.
+
+        Returns
+        -------
+        list
+            [{'uuid': str, 'style': str, 'font_before': sha256 of the before
+              font, 'hashes': {glyph key: hash}}, ...]
+        """
+        items = []
+        for style in sorted(self.shared_styles):
+            font_before = self.styles_before[style].font
+            font_after = self.styles_after[style].font
+            if font_before.is_vf or font_after.is_vf:
+                continue
+            items.append({
+                'uuid': self.uuid,
+                'style': style,
+                'font_before': font_before.sha256,
+                'hashes': font_after.glyph_hashes,
+            })
+        return items
+
+    def rank(self, diffs, pixels=True):
+        """Score the severity of each glyphs_modified item and sort the
+        items, most severe first.
+
+        An item's severity is the largest of its glyph's area change and
+        pixel difference, see pixel_scores. Diffs are stored in this order
+        so the most severe glyphs are in the first pages.
+
+        Parameters
+        ----------
+        diffs: list
+            serialised diffs returned by diff_families. Updated in place.
+        pixels: bool
+            Rasterise the glyphs to score their pixel difference. If False,
+            the severity is the area change alone.
+        """
+        for diff in diffs:
+            if diff['view'] != 'glyphs_modified' or not diff['items']:
+                continue
+            items = diff['items']
+            scores = {}
+            if pixels:
+                scores = self.pixel_scores(
+                    diff['font_before'], set(i['glyph']['key'] for i in items))
+            for item in items:
+                item['severity'] = abs(item['diff'])
+                if pixels:
+                    item['pixel_diff'] = round(
+                        scores.get(item['glyph']['key'], 0), 4)
+                    item['severity'] = max(item['severity'], item['pixel_diff'])
+                item['description'] = u'{} | {:.3f}'.format(
+                    item['glyph']['name'], item['severity'])
+            items.sort(key=lambda i: i['severity'], reverse=True)
+
+    def pixel_scores(self, style, keys=None):
+        """Return {glyph key: pixel difference} of a style's glyphs.
+
+        Glyphs are rendered and scored in batches the first time they're
+        needed, see gfregression.raster.diff_glyph_pixels.
+
+        Parameters
+        ----------
+        style: str
+        keys: set
+            keys of the glyphs to score. All glyphs if None.
+        """
+        glyphs, names_before, names_after = self._glyph_pairs(style)
+        scores = self._pixel_scores.setdefault(style, {})
+        todo = [i for i, g in enumerate(glyphs) if g.key not in scores and
+                (keys is None or g.key in keys)]
+        if todo:
+            rasteriser_before, rasteriser_after = self.rasterisers(style)
+            with timed('render_glyphs'):
+                new_scores = raster.diff_glyph_pixels(
+                    rasteriser_before, rasteriser_after,
+                    [names_before[i] for i in todo],
+                    [names_after[i] for i in todo])
+            for i, score in zip(todo, new_scores):
+                scores[glyphs[i].key] = float(score)
+        return {g.key: scores[g.key] for g in glyphs
+                if keys is None or g.key in keys}
+
+    def _glyph_pairs(self, style):
+        """Return the glyphs of a style's before font which are also in its
+        after font, and their names in each font"""
+        if style in self._pairs:
+            return self._pairs[style]
+        location_before, location_after = self.locations(style)
+        font_before = self.dfont(self.styles_before[style].font,
+                                 location_before)
+        font_after = self.dfont(self.styles_after[style].font, location_after)
+        # Glyphs are matched by key, the same as diffenator. Several glyphs
+        # can share a key so glyphs with the same name are matched first.
+        glyphset_after = font_after.glyphset
+        keys_after = {g.key: n for n, g in glyphset_after.items()}
+        glyphs = [g for _, g in sorted(font_before.glyphset.items())
+                  if g.key in keys_after]
+        names_before = [g.name for g in glyphs]
+        names_after = [
+            g.name if g.name in glyphset_after and
+            glyphset_after[g.name].key == g.key else keys_after[g.key]
+            for g in glyphs
+        ]
+        self._pairs[style] = glyphs, names_before, names_after
+        return self._pairs[style]
+
+    def rasterisers(self, style):
+        """Return GlyphRasterisers of a style's before and after fonts"""
+        if style not in self._rasterisers:
+            location_before, location_after = self.locations(style)
+            self._rasterisers[style] = (
+                raster.GlyphRasteriser(self.font_path(
+                    self.styles_before[style].font, location_before)),
+                raster.GlyphRasteriser(self.font_path(
+                    self.styles_after[style].font, location_after)),
+            )
+        return self._rasterisers[style]
+
+    def render(self, media_dir):
+        """Rasterise each shared style's glyphs and text samples and score
+        how much their pixels differ, see gfregression.raster.
+
+        The diff images are saved in media_dir:
+            <style>-glyphs.png: the RENDER_LIMIT most changed glyphs
+            <style>-waterfall.png
+            <style>-text.png
+
+        Returns
+        -------
+        list
+            A glyphs_pixels diff for each style. Its items are the glyphs
+            whose renderings differ, most changed first. The diff's images
+            holds the file names of its images and sample_scores the
+            scores of the waterfall and text.
+        """
+        os.makedirs(media_dir, exist_ok=True)
+        text = " ".join(self.words).lower() + " " + " ".join(self.words).upper()
+        samples = (
+            ('waterfall', raster.render_waterfall),
+            ('text', lambda path: raster.render_text(path, text,
+                                                     RENDER_TEXT_SIZE)),
+        )
+        diffs = []
+        for style in self.shared_styles:
+            style_before = self.styles_before[style]
+            style_after = self.styles_after[style]
+            glyphs, names_before, names_after = self._glyph_pairs(style)
+            scores = self.pixel_scores(style)
+            changed = sorted(
+                (i for i, g in enumerate(glyphs) if scores[g.key] > 0),
+                key=lambda i: scores[glyphs[i].key], reverse=True)
+            items = [{
+                'glyph': glyphs[i],
+                'string': glyphs[i].characters,
+                'features': glyphs[i].features,
+                'htmlfeatures': u', '.join(glyphs[i].features),
+                'description': u'{} | {:.3f}'.format(
+                    glyphs[i].name, scores[glyphs[i].key]),
+                'pixel_diff': round(scores[glyphs[i].key], 4),
+            } for i in changed]
+
+            images = {}
+            sample_scores = {}
+            rasteriser_before, rasteriser_after = self.rasterisers(style)
+            with timed('render_images'):
+                top = changed[:RENDER_LIMIT]
+                if top:
+                    before = rasteriser_before.render(
+                        [names_before[i] for i in top])
+                    after = rasteriser_after.render(
+                        [names_after[i] for i in top])
+                    sheet = raster.contact_sheet(
+                        [raster.diff_image(b, a)[0] for b, a in zip(before, after)])
+                    images['glyphs'] = '{}-glyphs.png'.format(style)
+                    sheet.save(os.path.join(media_dir, images['glyphs']))
+                for name, render in samples:
+                    image, score = raster.diff_image(
+                        render(rasteriser_before.path),
+                        render(rasteriser_after.path))
+                    images[name] = '{}-{}.png'.format(style, name)
+                    image.save(os.path.join(media_dir, images[name]))
+                    sample_scores[name] = round(score, 4)
+            diffs.append({
+                'uuid': self.uuid,
+                'title': 'Glyphs Pixels',
+                'view': 'glyphs_pixels',
+                'font_before': style_before.name,
+                'font_after': style_after.name,
+                'items': items,
+                'images': images,
+                'sample_scores': sample_scores,
+            })
+        with timed('serialise'):
+            return list(map(serialise_diff, diffs))
+
+    def text(self):
+        """Return a passage of text which can be formed using the words from
+        the UDHR and family_before[0].
+
+        This diff is useful to check whether the new family is going cause
+        document reflow issues"""
+        words = self.words
+        items = []
+        for style in self.shared_styles:
+            text = {
+                'uuid': self.uuid,
+                'title': 'Text',
+                'view': 'text',
+                'font_before': self.styles_before[style].name,
+                'font_after': self.styles_after[style].name,
+                'text': " ".join(words).lower() + " " + " ".join(words).upper()
+            }
+            items.append(text)
+        return items
+
+    def families(self):
+        """Return the families document used by the app's views. The
+        families are renamed so the before and after @font-faces don't
+        clash."""
+        family_before, family_after = self.family_before, self.family_after
+        family_before.set_name(family_before.name.replace(" ", "-") + '-before')
+        family_after.set_name(family_after.name.replace(" ", "-") + '-after')
+        return dict(
+            uuid=self.uuid,
+            before=dict(
+                name=family_before.name,
+                css_font_faces=[f.css_font_face for f in family_before.fonts],
+            ),
+            after=dict(
+                name=family_after.name,
+                css_font_faces=[f.css_font_face for f in family_after.fonts],
             ),
+            css_classes=[self.styles_before[s].css_class
+                         for s in self.shared_styles],
+            styles=list(self.shared_styles),
+            has_vfs=any([family_before.has_vfs, family_after.has_vfs])
         )
-        for cat in style_diff._data:
-            for subcat in style_diff._data[cat]:
-                diff = {
-                    'uuid': uuid,
-                    'title': '{} {}'.format(cat.title(), subcat.title()),
-                    'view': '{}_{}'.format(cat, subcat),
-                    'font_before': styles_before[style].name,
-                    'font_after': styles_after[style].name,
-                    'items': style_diff._data[cat][subcat]._data
-                }
-                diffs.append(diff)
-    return list(map(_diff_serialiser, diffs))
 
 
-def families_glyphs_all(family_before, family_after, uuid):
-    """Dump every glyph for each font in family_before.
+def diff_families(family_before, family_after, uuid, workers=1, cache=None,
+                  previous=None, vf_grid=0):
+    """Diff two families which have the same family name, see
+    FamilyComparison.diff_families"""
+    with FamilyComparison(family_before, family_after, uuid,
+                          vf_grid) as comparison:
+        return comparison.diff_families(workers, cache, previous)
+
+
+def _diff_style_from_paths(instances, path_before, path_after,
+                           location_before, location_after, style_before,
+                           style_after, uuid):
+    """Process pool entry point for diff_families. DFonts cannot be pickled
+    so each worker opens its own copy of the fonts. VF instances made by
+    any process are reused, see gfregression.variations.InstanceCache.
+
+    instances is the (directory, max_size) of the comparison's
+    InstanceCache, or None if neither font is a VF."""
+    if instances is None:
+        with timed('parse_font'):
+            font_before, font_after = DFont(path_before), DFont(path_after)
+        return _diff_style(font_before, font_after, style_before,
+                           style_after, uuid)
+    instances = variations.instance_cache(*instances)
+    return _diff_style(instances.font(path_before, location_before),
+                       instances.font(path_after, location_after),
+                       style_before, style_after, uuid)
+
+
+def _diff_style(font_a, font_b, style_before, style_after, uuid):
+    """Diff a single style and return the serialised diffs for each
+    category. VFs must already be instanced at the style's location, see
+    FamilyComparison.locations."""
+    with timed('glyph_arrays'):
+        arrays_a = vectorised.GlyphArrays(font_a)
+        arrays_b = vectorised.GlyphArrays(font_b)
+    # Run each category separately so they can be timed. The glyphs and
+    # metrics are compared with numpy rather than diffenator's python loops
+    style_diff = DiffFonts(font_a, font_b, settings=dict(to_diff=[]))
+    for cat in sorted(DIFF_CATEGORIES):
+        with timed('diff_{}'.format(cat)):
+            if cat in VECTORISED_DIFFS:
+                style_diff._data[cat] = VECTORISED_DIFFS[cat](arrays_a,
+                                                              arrays_b)
+            else:
+                getattr(style_diff, cat)()
+    return _style_diffs(style_diff._data, style_before, style_after, uuid)
+
+
+def _diff_style_incremental(font_before, font_after, style_before,
+                            style_after, uuid, previous):
+    """Diff a style of a family which has been diffed before.
+
+    The glyphs and metrics rows of glyphs whose hash hasn't changed since
+    the previous upload are reused. Only the changed glyphs are dumped
+    and diffed. The other categories are diffed in full.
 
-    This diff is useful to see whether family_after can access all the glyphs
-    in family_before
+    Parameters
+    ----------
+    font_before: Font
+    font_after: Font
+    previous: dict
+        see diff_families
     """
-    styles_before = {s.name: s for f in family_before.fonts for s in f.styles}
-    styles_after = {s.name: s for f in family_after.fonts for s in f.styles}
-
-    shared_styles = set(styles_before) & set(styles_after)
-    items = []
-    for style in shared_styles:
-        font_a = styles_before[style].font.font
-        font_b = styles_after[style].font.font
-
-        all_glyphs = {
-            'uuid': uuid,
-            'title': 'Glyph All',
-            'view': 'glyphs_all',
-            'font_before': styles_before[style].name,
-            'font_after': styles_after[style].name,
-            'items': dump_glyphs(styles_before[style].font.font)._data,
-        }
-        items.append(all_glyphs)
-    return list(map(_diff_serialiser, items))
+    dfont_before, dfont_after = font_before.lazy_font, font_after.lazy_font
+    changed = incremental.changed_keys(previous['hashes'],
+                                       font_after.glyph_hashes)
+
+    with timed('glyph_arrays'):
+        arrays_before = vectorised.GlyphArrays(
+            dfont_before, *incremental.glyph_rows(dfont_before, changed))
+        arrays_after = vectorised.GlyphArrays(
+            dfont_after, *incremental.glyph_rows(dfont_after, changed))
+    with timed('load_tables'):
+        incremental.load_tables(dfont_before)
+        incremental.load_tables(dfont_after)
+
+    style_diff = DiffFonts(dfont_before, dfont_after, settings=dict(to_diff=[]))
+    for cat in sorted(DIFF_CATEGORIES):
+        with timed('diff_{}'.format(cat)):
+            if cat in VECTORISED_DIFFS:
+                style_diff._data[cat] = VECTORISED_DIFFS[cat](arrays_before,
+                                                              arrays_after)
+            else:
+                getattr(style_diff, cat)()
+    diffs = _style_diffs(style_diff._data, style_before, style_after, uuid)
+
+    # Add the previous items of the glyphs which haven't changed
+    for diff in diffs:
+        if diff['view'] not in incremental.INCREMENTAL_VIEWS:
+            continue
+        reused = [dict(item) for item in previous['diffs'].get(diff['view'], [])
+                  if item['glyph']['key'] not in changed]
+        diff['items'] = sorted(diff['items'] + reused,
+                               **INCREMENTAL_VIEW_ORDER[diff['view']])
+    return diffs
+
+
+def _style_diffs(data, style_before, style_after, uuid):
+    """Return the serialised diffs of each category of a DiffFonts"""
+    diffs = []
+    for cat in data:
+        for subcat in data[cat]:
+            diff = {
+                'uuid': uuid,
+                'title': '{} {}'.format(cat.title(), subcat.title()),
+                'view': '{}_{}'.format(cat, subcat),
+                'font_before': style_before,
+                'font_after': style_after,
+                'items': data[cat][subcat]._data
+            }
+            diffs.append(diff)
+    with timed('serialise'):
+        return list(map(serialise_diff, diffs))
+
+
+def families_glyphs_all(family_before, family_after, uuid):
+    """see FamilyComparison.glyphs_all"""
+    with FamilyComparison(family_before, family_after, uuid) as comparison:
+        return comparison.glyphs_all()
+
+
+def families_glyph_hashes(family_before, family_after, uuid):
+    """see FamilyComparison.glyph_hashes"""
+    with FamilyComparison(family_before, family_after, uuid) as comparison:
+        return comparison.glyph_hashes()
 
 
 def families_text(family_before, family_after, uuid):
-    """Return a passage of text which can be formed using the words from the
-    UDHR and family_before[0].
-
-    This diff is useful to check whether the new family is going cause
-    document reflow issues"""
-    styles_before = {s.name: s for f in family_before.fonts for s in f.styles}
-    styles_after = {s.name: s for f in family_after.fonts for s in f.styles}
-
-    shared_styles = set(styles_before) & set(styles_after)
-    words = udhr_font_words(family_before.fonts[0].font.ttfont)
-    items = []
-    for style in shared_styles:
-        font_a = styles_before[style].font.font
-        font_b = styles_after[style].font.font
-
-        text = {
-            'uuid': uuid,
-            'title': 'Text',
-            'view': 'text',
-            'font_before': styles_before[style].name,
-            'font_after': styles_after[style].name,
-            'text': " ".join(words).lower() + " " + " ".join(words).upper()
-        }
-        items.append(text)
-    return items
+    """see FamilyComparison.text"""
+    with FamilyComparison(family_before, family_after, uuid) as comparison:
+        return comparison.text()
 
 
 def udhr_font_words(ttFont):
@@ -510,59 +1208,35 @@ def udhr_font_words(ttFont):
     that can be formed using the ttFont instance.
 
     UDHR has been chosen due to the many languages it covers"""
-    with open(os.path.join(current_dir, "udhr_all.txt"), "r") as doc:
-        text = doc.read()
-
-    cmap = set(ttFont.getBestCmap())
-    words = []
-    seen_chars = set()
-    for word in text.split():
-        chars = set(ord(l) for l in word)
-        if not chars.issubset(cmap):
-            continue
-        if chars & seen_chars == chars:
-            continue
-        seen_chars |= chars
-        words.append(word)
-    return words
-
-
-def _diff_serialiser(d):
-    """Serialise diffenator's diff object"""
-    for k in d:
-        if isinstance(d[k], dict):
-            _diff_serialiser(d[k])
-        if isinstance(d[k], list):
-            for idx, item in enumerate(d[k]):
-                _diff_serialiser(item)
-        if hasattr(d[k], 'font'):
-            d[k].font = None
-        if hasattr(d[k], 'key'):
-            d[k] = dict(d[k].__dict__)
-    return d
+    return udhr_index().font_words(ttFont.getBestCmap())
 
 
 def get_families(family_before, family_after, uuid):
-    family_before.set_name(family_before.name.replace(" ", "-") + '-before')
-    family_after.set_name(family_after.name.replace(" ", "-") + '-after')
-
-    styles_before = {s.name: s for f in family_before.fonts for s in f.styles}
-    styles_after = {s.name: s for f in family_after.fonts for s in f.styles}
-
-    shared_styles = set(styles_before) & set(styles_after)
-    return dict(
-        uuid=uuid,
-        before=dict(
-            name=family_before.name,
-            css_font_faces=[f.css_font_face for f in family_before.fonts],
-        ),
-        after=dict(
-            name=family_after.name,
-            css_font_faces=[f.css_font_face for f in family_after.fonts],
-        ),
-        css_classes=[s.css_class for f in family_before.fonts for s in f.styles
-                     if s.name in shared_styles],
-        styles=[s.name for f in family_before.fonts for s in f.styles
-                if s.name in shared_styles],
-        has_vfs=any([family_before.has_vfs, family_after.has_vfs])
-    )
+    """see FamilyComparison.families"""
+    with FamilyComparison(family_before, family_after, uuid) as comparison:
+        return comparison.families()
+
+
+def families_stylesheet(families):
+    """Assemble the stylesheet used by the compare and screenshot views.
+
+    Parameters
+    ----------
+    families: dict
+        families document, see FamilyComparison.families
+
+    Returns
+    -------
+    str
+        The before and after @font-faces, a class per style and the
+        classes which swap between the before and after families
+    """
+    rules = (families['before']['css_font_faces'] +
+             families['after']['css_font_faces'] +
+             families['css_classes'])
+    for position in ('before', 'after'):
+        rules.append(""".swap-fonts-%s {
+                display: block;
+                font-family: %s;
+            }""" % (position, families[position]['name']))
+    return '\n'.join(rules) + '\n'
@@ -0,0 +1,200 @@
+"""Benchmark the upload to diff pipeline.
+
+Each case diffs a before and after family the same way a job worker
+does: the fonts are loaded, FamilyComparison.run diffs, ranks and renders
+them, and the results can optionally be inserted into rethinkdb. Every
+case runs in a fresh process so its peak RSS isn't inflated by the
+previous cases.
+
+Run from the repo root to use the fixtures in tests/data. Inserts are
+paged by the app's diff_pages module, which is imported from app/:
+
+    gfregression-benchmark
+    gfregression-benchmark --case cjk path/to/before path/to/after --json out.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+from multiprocessing import Process, Pipe
+from gfregression import family_from_paths, FamilyComparison
+from gfregression.timing import timed, record
+
+
+# (name, fonts before dir, fonts after dir). The static-vs-vf case diffs
+# Cabin's VF against Roboto's statics. The families don't match but the
+# shared styles are diffed the same way as a real static to VF upload.
+FIXTURE_CASES = [
+    ('static', 'tests/data/Roboto', 'tests/data/Roboto'),
+    ('vf', 'tests/data/Cabin', 'tests/data/Cabin'),
+    ('static-vs-vf', 'tests/data/Cabin', 'tests/data/Roboto'),
+]
+# Dir of the app's modules, relative to the repo root
+APP_DIR = 'app'
+# Scratch db the results are inserted into
+BENCHMARK_DB = 'gfregression_benchmark'
+
+def run_case(before_dir, after_dir, workers=1, rdb_host=None):
+    """Run the pipeline once and return its timings.
+
+    Returns
+    -------
+    dict
+        {'wall': seconds, 'peak_rss_mb': float,
+         'stages': {stage: seconds}}
+    """
+    uuid = 'benchmark'
+    tmp_dir = tempfile.mkdtemp()
+    conn = _scratch_db(rdb_host) if rdb_host else None
+    try:
+        # Families rename their fonts so work on copies
+        paths_before = _copy_fonts(before_dir, os.path.join(tmp_dir, 'before'))
+        paths_after = _copy_fonts(after_dir, os.path.join(tmp_dir, 'after'))
+        start = time.perf_counter()
+        with record() as times:
+            with timed('load'):
+                family_before = family_from_paths(paths_before, tmp_dir)
+                family_after = family_from_paths(paths_after, tmp_dir)
+            with FamilyComparison(family_before, family_after,
+                                  uuid) as comparison:
+                diff, glyph_hashes, families = comparison.run(
+                    workers=workers,
+                    media_dir=os.path.join(tmp_dir, 'media'),
+                )
+            if conn:
+                with timed('db_insert'):
+                    _insert(conn, diff, glyph_hashes, families)
+        wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if conn:
+            _drop_scratch_db(conn)
+    return {
+        'wall': wall,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'stages': dict(times),
+    }
+
+
+def _copy_fonts(src, dst):
+    os.makedirs(dst)
+    paths = []
+    for path in sorted(glob(os.path.join(src, '*.ttf'))):
+        paths.append(shutil.copy(path, dst))
+    if not paths:
+        raise Exception('{} contains no ttfs'.format(src))
+    return paths
+
+
+def _scratch_db(rdb_host):
+    """Create the app's tables and indexes in an empty scratch db and
+    return a connection to it"""
+    import rethinkdb as r
+    sys.path.insert(0, APP_DIR)
+    import init_db
+    conn = r.connect(host=rdb_host, port=28015)
+    if BENCHMARK_DB in r.db_list().run(conn):
+        r.db_drop(BENCHMARK_DB).run(conn)
+    init_db.build_tables(host=rdb_host, port=28015, db=BENCHMARK_DB)
+    conn.use(BENCHMARK_DB)
+    return conn
+
+
+def _drop_scratch_db(conn):
+    import rethinkdb as r
+    try:
+        r.db_drop(BENCHMARK_DB).run(conn)
+    finally:
+        conn.close()
+
+
+def _insert(conn, diff, glyph_hashes, families):
+    """Insert the results the same way a job worker does, see
+    app/jobs.py"""
+    import rethinkdb as r
+    import diff_pages
+    diff_pages.insert(conn, diff)
+    if glyph_hashes:
+        r.table('glyph_hashes').insert(glyph_hashes).run(conn)
+    r.table('families').insert(families).run(conn)
+
+
+def _run_case_in_process(conn, *args):
+    conn.send(run_case(*args))
+    conn.close()
+
+
+def run_isolated(*args):
+    """Run run_case in a new process"""
+    parent_conn, child_conn = Pipe()
+    process = Process(target=_run_case_in_process, args=(child_conn,) + args)
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+def report(results):
+    """Format results as a table"""
+    lines = []
+    for name, result in results['cases'].items():
+        lines.append('{}: {:.2f}s wall, {:.1f}MB peak RSS'.format(
+            name, result['wall'], result['peak_rss_mb']))
+        for stage, seconds in sorted(result['stages'].items(),
+                                     key=lambda s: s[1], reverse=True):
+            lines.append('    {:<22} {:8.3f}s'.format(stage, seconds))
+    return '\n'.join(lines)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--case', nargs=3, action='append',
+                        metavar=('NAME', 'BEFORE_DIR', 'AFTER_DIR'),
+                        help='Family dirs to benchmark. Defaults to the '
+                             'fixtures in tests/data')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='Run each case this many times and keep the '
+                             'fastest run')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes used by diff_families')
+    parser.add_argument('--rdb-host',
+                        help='Also time inserting the results into '
+                             'rethinkdb running on this host')
+    parser.add_argument('--label', default=_git_revision(),
+                        help='Label stored in the json output. Defaults to '
+                             'the git revision')
+    parser.add_argument('--json', help='Write the results to this path')
+    args = parser.parse_args(args)
+
+    cases = args.case or FIXTURE_CASES
+    results = {'label': args.label, 'cases': {}}
+    for name, before_dir, after_dir in cases:
+        runs = [run_isolated(before_dir, after_dir, args.workers, args.rdb_host)
+                for _ in range(args.runs)]
+        results['cases'][name] = min(runs, key=lambda r: r['wall'])
+
+    print(report(results))
+    if args.json:
+        with open(args.json, 'w') as doc:
+            json.dump(results, doc, indent=2)
+
+
+if __name__ == '__main__':
+    main()
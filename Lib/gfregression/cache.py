@@ -0,0 +1,154 @@
+"""Disk caches which are shared between uploads"""
+import hashlib
+import os
+import shutil
+import tempfile
+from gfregression.serialise import dumps, loads
+
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as doc:
+        for chunk in iter(lambda: doc.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """Size bounded cache of files or directories stored under root.
+
+    Entries are evicted least recently used first, using each entry's
+    mtime, once the cache holds more than max_size bytes.
+
+    Parameters
+    ----------
+    root: str
+        dir to store entries in
+    max_size: int
+        maximum size of the cache in bytes
+    """
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def touch(self, key):
+        """Mark an entry as recently used"""
+        os.utime(self.path(key))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_size"""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.tmp'):
+                # entry which is still being written
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                entries.append((os.stat(path).st_mtime, _size(path), path))
+            except FileNotFoundError:
+                # removed by another process
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            _remove(path)
+            total -= size
+
+
+class DiffCache(DiskCache):
+    """Cache of serialised style diffs. Each entry is a json file."""
+
+    def get(self, key):
+        """Return the cached diffs for key or None if they don't exist"""
+        try:
+            with open(self.path(key), 'rb') as doc:
+                diffs = loads(doc.read())
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            self.touch(key)
+        except FileNotFoundError:
+            # evicted by another process since it was read
+            pass
+        self.hits += 1
+        return diffs
+
+    def set(self, key, diffs):
+        """Store diffs. The entry is written to a temporary file first so
+        readers in other processes never see a partial entry."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as doc:
+            doc.write(dumps(diffs))
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+
+def diff_cache_key(font_before, font_after, style_before, style_after,
+                   to_diff, version, format_version, locations=(None, None)):
+    """Key for a style diff.
+
+    Parameters
+    ----------
+    font_before: Font
+    font_after: Font
+    style_before: str
+    style_after: str
+    to_diff: iterable
+        fontdiffenator categories which were diffed
+    version: str
+        fontdiffenator version
+    format_version: int
+        gfregression's DIFF_FORMAT_VERSION
+    locations: tuple
+        (location before, location after) the fonts were diffed at, see
+        FamilyComparison.locations
+
+    Returns
+    -------
+    key: str
+    """
+    digest = hashlib.sha256()
+    locations = repr(tuple(None if location is None else sorted(location.items())
+                           for location in locations))
+    for part in (font_before.sha256, font_after.sha256, style_before,
+                 style_after, ','.join(sorted(to_diff)), version,
+                 str(format_version), locations):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,77 +1,288 @@
 """
 Module for downloading fonts
 """
+import bisect
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlparse
 from zipfile import ZipFile
 import shutil
+import tempfile
+import time
 import uuid
+from gfregression.cache import DiskCache
 
-try:
-    from StringIO import StringIO
-except ModuleNotFoundError:  # py3 workaround
-    from io import BytesIO as StringIO
+
+# Dir used to cache downloads between runs
+CACHE_DIR = os.environ.get(
+    'GFR_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'gfregression')
+)
+# Seconds before the cached Google Fonts API listing is revalidated
+API_CACHE_TTL = 60 * 60
+# Max size in bytes of the cache of fonts downloaded from Google Fonts
+FAMILY_CACHE_SIZE = int(os.environ.get('GFR_FAMILY_CACHE_SIZE', 1024 ** 3))
+
+# Downloads are written to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Max number of files download_files fetches at once
+DOWNLOAD_WORKERS = 8
+# Max number of concurrent requests to a single host
+DOWNLOAD_HOST_LIMIT = 4
+# Failed requests are retried, waiting DOWNLOAD_BACKOFF * 2 ** retry secs
+# between each attempt
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+
+# In process copies of the API listing. {cache_path: entry}
+_api_cache = {}
+
+_session = None
+_session_pid = None
+_host_limits = {}
+_lock = Lock()
+
+
+def session():
+    """Return the process's shared requests session.
+
+    Connections are pooled between requests and failed requests are
+    retried with exponential backoff."""
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(
+                total=DOWNLOAD_RETRIES,
+                backoff_factor=DOWNLOAD_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+            )
+            adapter = HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS,
+                                  max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def _host_limit(url):
+    """Semaphore which limits the number of concurrent requests to url's
+    host"""
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _host_limits:
+            _host_limits[host] = BoundedSemaphore(DOWNLOAD_HOST_LIMIT)
+        return _host_limits[host]
 
 
 def download_file(url, dst=None):
-    """Download a file from a url. If no url is specified, store the file
-    as a StringIO object"""
-    request = requests.get(url, stream=True)
-    if not dst:
-        return StringIO(request.content)
-    with open(dst, 'wb') as downloaded_file:
-        shutil.copyfileobj(request.raw, downloaded_file)
+    """Download a file from a url. If no dst is specified, return the file
+    as an anonymous temporary file, seeked to the start.
+
+    The response is streamed to disk in chunks so large files e.g CJK
+    family zips are never held in memory."""
+    with _host_limit(url):
+        request = session().get(url, stream=True)
+        request.raise_for_status()
+        if not dst:
+            downloaded_file = tempfile.TemporaryFile()
+            _write_chunks(request, downloaded_file)
+            downloaded_file.seek(0)
+            return downloaded_file
+        with open(dst, 'wb') as downloaded_file:
+            _write_chunks(request, downloaded_file)
+
+
+def download_files(downloads, workers=DOWNLOAD_WORKERS):
+    """Download several files at once.
+
+    Parameters
+    ----------
+    downloads: list
+        [(url, dst), ...]
+    workers: int
+        max number of files to download at once
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # consume the results so download errors are raised
+        list(pool.map(lambda d: download_file(*d), downloads))
+
+
+def _write_chunks(request, doc):
+    for chunk in request.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        doc.write(chunk)
 
 
 class GoogleFonts(object):
-    """Primitive python client to control Googlefonts api and fonts.google.com"""
-    def __init__(self, api_key=None):
+    """Primitive python client to control Googlefonts api and fonts.google.com
+
+    The API listing is cached in process and on disk in cache_dir. Once
+    it is older than ttl seconds, it is revalidated using its ETag and
+    Last-Modified headers.
+
+    Downloaded families are also kept in cache_dir, keyed by each family's
+    version and lastModified date in the API listing, so a release is only
+    downloaded once."""
+    def __init__(self, api_key=None, cache_dir=CACHE_DIR, ttl=API_CACHE_TTL):
         if not api_key:
             self.api_key = os.environ["GF_API_KEY"]
         else:
             self.api_key = api_key
+        self.cache_path = os.path.join(cache_dir, 'webfonts.json')
+        self.ttl = ttl
         self.data = self._get_api_data()
         self.families = [f['family'] for f in self.data['items']]
+        self._families_set = set(self.families)
+        self._families_sorted = sorted(self.families)
+        self._families_meta = {f['family']: f for f in self.data['items']}
+        self.family_cache = DiskCache(os.path.join(cache_dir, 'families'),
+                                      FAMILY_CACHE_SIZE)
 
     def _get_api_data(self):
         api_url = 'https://www.googleapis.com/webfonts/v1/webfonts?key={}'.format(
             self.api_key
         )
-        return requests.get(api_url).json()
+        cached = _api_cache.get(self.cache_path) or self._read_api_cache()
+        if cached and time.time() - cached['fetched'] < self.ttl:
+            _api_cache[self.cache_path] = cached
+            return cached['data']
+
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+        request = session().get(api_url, headers=headers)
+        if cached and request.status_code == 304:
+            cached['fetched'] = time.time()
+        else:
+            request.raise_for_status()
+            cached = {
+                'fetched': time.time(),
+                'etag': request.headers.get('ETag'),
+                'last_modified': request.headers.get('Last-Modified'),
+                'data': request.json(),
+            }
+        self._write_api_cache(cached)
+        _api_cache[self.cache_path] = cached
+        return cached['data']
+
+    def _read_api_cache(self):
+        try:
+            with open(self.cache_path) as doc:
+                return json.load(doc)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_api_cache(self, cached):
+        cache_dir = os.path.dirname(self.cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as doc:
+            json.dump(cached, doc)
+        os.replace(tmp_path, self.cache_path)
 
     def download_family(self, family, dst):
         """Download a collection of font families from Google Fonts"""
         has_family = self.has_family(family)
         if not has_family:
             raise Exception('Family {} does not exist on Google Fonts!'.format(family))
+        key = self._family_cache_key(family)
+        fonts = []
+        if key in self.family_cache:
+            fonts = self._cached_fonts(key, dst)
+        if fonts:
+            self.family_cache.hits += 1
+            return fonts
+        self.family_cache.misses += 1
+        return self._cache_family(family, key, dst)
+
+    def _cached_fonts(self, key, dst):
+        """Copy a cached family's fonts to dst. Returns an empty list if
+        another process evicted the family."""
+        try:
+            self.family_cache.touch(key)
+            return _copy_fonts(self.family_cache.path(key), dst)
+        except FileNotFoundError:
+            return []
+
+    def _family_cache_key(self, family):
+        meta = self._families_meta[family]
+        return '{}-{}-{}'.format(
+            family.replace(' ', '_'),
+            meta.get('version', ''),
+            meta.get('lastModified', ''),
+        )
+
+    def _cache_family(self, family, key, dst):
+        """Download a family, copy its fonts to dst and add them to the
+        family cache.
+
+        The fonts are copied before the family is cached, so they are
+        returned even if the family is evicted straight away, e.g because
+        it is larger than the cache."""
         url = 'https://fonts.google.com/download?family={}'.format(
             family.replace(' ', '%20')
         )
-        fonts_zip = ZipFile(download_file(url))
-        fonts_paths = _fonts_from_zip(fonts_zip, dst)
-        return fonts_paths
+        # Extract to a temporary dir first so other processes never use a
+        # partially extracted family
+        tmp_dir = tempfile.mkdtemp(dir=self.family_cache.root, suffix='.tmp')
+        try:
+            with download_file(url) as zip_file, ZipFile(zip_file) as fonts_zip:
+                _fonts_from_zip(fonts_zip, tmp_dir)
+            fonts = _copy_fonts(tmp_dir, dst)
+            if not fonts:
+                raise Exception(
+                    'Family {} has no fonts on Google Fonts!'.format(family))
+        except Exception:
+            # The cache doesn't evict .tmp dirs
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_dir, self.family_cache.path(key))
+        except OSError:
+            # Another process cached the family first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.family_cache.evict()
+        return fonts
+
+    def download_families(self, families, dst, workers=DOWNLOAD_WORKERS):
+        """Download several families from Google Fonts at once.
+
+        Returns
+        -------
+        fonts: list
+            The font paths for each family, in the same order as families
+        """
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(
+                lambda family: self.download_family(family, dst), families
+            ))
 
     def has_family(self, family):
         """Check if Google Fonts has the specified font family"""
-        if family in self.families:
-            return True
-        return False
+        return family in self._families_set
 
     def related_families(self, string):
+        """Return the families whose names start with string"""
         results = []
-        for family in self.families:
-            if string in family:
-                results.append(family)
+        idx = bisect.bisect_left(self._families_sorted, string)
+        for family in self._families_sorted[idx:]:
+            if not family.startswith(string):
+                break
+            results.append(family)
         return results
 
     def width_families(self, string):
         results = []
-        for family in self.families:
-            if (string in family and "Condensed" in family) or \
-               (string in family and "Expanded" in family):
-                   results.append(family)
+        for family in self.related_families(string):
+            if "Condensed" in family or "Expanded" in family:
+                results.append(family)
         results.insert(0, string)
         return results
 
@@ -79,8 +290,9 @@ class GoogleFonts(object):
 def github_dir(url, dst):
     """Download fonts from a github repo directory"""
     fonts = []
+    downloads = []
     branch, api_url = _convert_github_url_to_api(url)
-    request = requests.get(api_url, params={'ref': branch})
+    request = session().get(api_url, params={'ref': branch})
     api_request = json.loads(request.text)
     for item in api_request:
         if not 'download_url' in item:
@@ -88,7 +300,8 @@ def github_dir(url, dst):
         dl_url = item['download_url']
         file_path = os.path.join(dst, item['name'])
         fonts.append(file_path)
-        download_file(dl_url, file_path)
+        downloads.append((dl_url, file_path))
+    download_files(downloads)
     return fonts
 
 
@@ -114,16 +327,35 @@ def _convert_github_url_to_api(url):
     )
 
 
+def _copy_fonts(src, dst):
+    """Copy the fonts in a cached family dir to dst. Hard links are used
+    if src and dst are on the same file system."""
+    fonts = []
+    for dirpath, _, filenames in os.walk(src):
+        for filename in sorted(filenames):
+            src_path = os.path.join(dirpath, filename)
+            dst_path = os.path.join(dst, os.path.relpath(src_path, src))
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copyfile(src_path, dst_path)
+            fonts.append(dst_path)
+    return fonts
+
+
 def _fonts_from_zip(zipfile, dst):
-    """download the fonts and store them locally"""
+    """Extract the fonts from a zip and store them locally. Only the ttfs
+    which are kept are decompressed."""
     fonts = []
-    for filename in zipfile.namelist():
+    for member in zipfile.infolist():
+        filename = member.filename
         if filename.endswith(".ttf"):
             # ignore files which exist in static dirs.
             if 'static' in filename:
                 continue
             target = os.path.join(dst, filename)
-            zipfile.extract(filename, dst)
+            zipfile.extract(member, dst)
             fonts.append(target)
     return fonts
 
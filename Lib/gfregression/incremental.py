@@ -0,0 +1,140 @@
+"""Per glyph hashes used to rediff only the glyphs which have changed.
+
+The CI bot uploads a new revision of a family for every commit to a PR.
+Usually only a handful of glyphs change between revisions, so the
+glyphs and metrics diffs of the previous upload can be reused for the
+glyphs whose hash is the same, see gfregression.diff_families.
+
+A glyph's hash covers its decomposed outline, advance and anchors. Glyphs are
+identified by their key, the glyph's characters and features, which is
+how diffenator matches glyphs between fonts.
+"""
+import hashlib
+from collections import defaultdict
+from fontTools.pens.recordingPen import DecomposingRecordingPen
+from diffenator.dump import (
+    DumpAnchors,
+    dump_glyphs,
+    dump_glyph_metrics,
+    dump_kerning,
+    dump_nametable,
+)
+
+__all__ = [
+    'INCREMENTAL_VIEWS',
+    'glyph_hashes',
+    'changed_keys',
+    'load_tables',
+    'glyph_rows',
+]
+
+# Views whose items each describe a single glyph
+INCREMENTAL_VIEWS = (
+    'glyphs_new',
+    'glyphs_missing',
+    'glyphs_modified',
+    'metrics_modified',
+)
+
+
+def glyph_hashes(font):
+    """Hash each glyph of a static font.
+
+    Parameters
+    ----------
+    font: DFont
+
+    Returns
+    -------
+    {glyph key: hex digest}
+        Glyphs which share a key are hashed together.
+    """
+    ttfont = font.ttfont
+    glyphset = ttfont.getGlyphSet()
+    hmtx = ttfont['hmtx']
+    anchors = _glyph_anchors(ttfont)
+
+    digests = defaultdict(list)
+    for name, glyph in font.glyphset.items():
+        # Composites are decomposed so they change with their components
+        pen = DecomposingRecordingPen(glyphset)
+        glyphset[name].draw(pen)
+        data = repr((name, pen.value, hmtx[name], anchors.get(name)))
+        digests[glyph.key].append(data)
+    return {key: hashlib.sha1('\n'.join(sorted(data)).encode('utf-8')).hexdigest()
+            for key, data in digests.items()}
+
+
+def _glyph_anchors(ttfont):
+    """Return {glyph name: [(lookup index, anchor class, x, y), ...]} for
+    the mark to base and mark to mark lookups"""
+    anchors = defaultdict(list)
+    if 'GPOS' not in ttfont:
+        return anchors
+    lookups = ttfont['GPOS'].table.LookupList.Lookup
+    for lookup_idx, lookup in enumerate(lookups):
+        for sub_table in lookup.SubTable:
+            if hasattr(sub_table, 'ExtSubTable'):
+                sub_table = sub_table.ExtSubTable
+            if sub_table.LookupType == 4:
+                marks = (sub_table.MarkCoverage, sub_table.MarkArray.MarkRecord)
+                bases = (sub_table.BaseCoverage, sub_table.BaseArray.BaseRecord,
+                         'BaseAnchor')
+            elif sub_table.LookupType == 6:
+                marks = (sub_table.Mark1Coverage,
+                         sub_table.Mark1Array.MarkRecord)
+                bases = (sub_table.Mark2Coverage,
+                         sub_table.Mark2Array.Mark2Record, 'Mark2Anchor')
+            else:
+                continue
+
+            coverage, records = marks
+            for name, record in zip(coverage.glyphs, records):
+                anchors[name].append((lookup_idx, record.Class,
+                                      record.MarkAnchor.XCoordinate,
+                                      record.MarkAnchor.YCoordinate))
+            coverage, records, attr = bases
+            for name, record in zip(coverage.glyphs, records):
+                for anchor_class, anchor in enumerate(getattr(record, attr)):
+                    if anchor:
+                        anchors[name].append((lookup_idx, anchor_class,
+                                              anchor.XCoordinate,
+                                              anchor.YCoordinate))
+    return anchors
+
+
+def changed_keys(hashes_before, hashes_after):
+    """Return the glyph keys which have been added, removed or whose hash
+    differs"""
+    changed = set(hashes_before) ^ set(hashes_after)
+    for key in set(hashes_before) & set(hashes_after):
+        if hashes_before[key] != hashes_after[key]:
+            changed.add(key)
+    return changed
+
+
+def load_tables(font):
+    """Dump the tables of a lazy DFont which can't be diffed glyph by
+    glyph"""
+    anchors = DumpAnchors(font)
+    font.marks = anchors.marks_table
+    font.mkmks = anchors.mkmks_table
+    font.kerns = dump_kerning(font)
+    font.names = dump_nametable(font)
+
+
+def glyph_rows(font, keys):
+    """Dump the glyphs and metrics rows of a DFont's glyphs whose key is in
+    keys.
+
+    Returns
+    -------
+    (glyphs, metrics)
+        DFontTables with the same rows as DFont.glyphs and DFont.metrics
+    """
+    glyphset = font.glyphset
+    font.glyphset = {n: g for n, g in glyphset.items() if g.key in keys}
+    try:
+        return dump_glyphs(font), dump_glyph_metrics(font)
+    finally:
+        font.glyphset = glyphset
@@ -0,0 +1,213 @@
+"""Rasterise glyphs and text samples and compare their pixels.
+
+Glyphs are rendered with FreeType into numpy arrays. Every glyph is
+drawn on a canvas of the same size with its origin at the same point,
+so the before and after renderings of a glyph can be compared pixel by
+pixel. Glyphs are rendered and scored in batches so the memory used
+doesn't depend on the number of glyphs in a font.
+
+Text samples, such as the waterfall, are rendered with Pillow.
+
+Diffs are drawn in red where only the before font has ink, blue where
+only the after font has ink and black where both do.
+"""
+import numpy as np
+import freetype
+from fontTools.ttLib import TTFont
+from PIL import Image, ImageDraw, ImageFont
+
+__all__ = [
+    'GlyphRasteriser',
+    'pixel_scores',
+    'diff_glyph_pixels',
+    'render_text',
+    'render_waterfall',
+    'diff_image',
+    'contact_sheet',
+]
+
+# Pixels per em of rendered glyphs
+GLYPH_SIZE = 48
+# Number of glyphs rendered and scored at once
+BATCH_SIZE = 256
+
+WATERFALL_TEXT = (
+    'QUICK WAFTING ZEPHYRS VEX BOLD JIM.\n'
+    'quick wafting zephyrs vex bold jim.\n'
+    '$14.95'
+)
+# Point sizes of the waterfall view, rendered at 96 dpi
+WATERFALL_SIZES = range(7, 22)
+
+
+class GlyphRasteriser:
+    """Render a font's glyphs by name.
+
+    Parameters
+    ----------
+    path: str
+        Path to a static font
+    size: int
+        Pixels per em
+    """
+    def __init__(self, path, size=GLYPH_SIZE):
+        self.path = path
+        self.face = freetype.Face(path)
+        self.face.set_pixel_sizes(0, size)
+        self.glyph_ids = {n: i for i, n in
+                          enumerate(TTFont(path, lazy=True).getGlyphOrder())}
+        # Canvases fit glyphs which extend half an em past their advance
+        # and below the descender
+        self.shape = (size * 2, size * 2)
+        self.origin = (int(size * 1.4), size // 2)
+
+    def render(self, names):
+        """Return an array of shape (len(names), height, width) holding
+        each glyph's coverage from 0 to 255"""
+        canvases = np.zeros((len(names),) + self.shape, dtype=np.uint8)
+        flags = freetype.FT_LOAD_RENDER | freetype.FT_LOAD_NO_HINTING
+        for canvas, name in zip(canvases, names):
+            self.face.load_glyph(self.glyph_ids[name], flags)
+            slot = self.face.glyph
+            bitmap = slot.bitmap
+            if not bitmap.rows:
+                continue
+            pixels = np.array(bitmap.buffer, dtype=np.uint8).reshape(
+                bitmap.rows, bitmap.pitch)[:, :bitmap.width]
+            _paste(canvas, pixels, self.origin[0] - slot.bitmap_top,
+                   self.origin[1] + slot.bitmap_left)
+        return canvases
+
+
+def _paste(canvas, pixels, top, left):
+    """Copy pixels into canvas at top, left, clipping whatever doesn't fit"""
+    height, width = canvas.shape
+    y0, x0 = max(top, 0), max(left, 0)
+    y1 = min(top + pixels.shape[0], height)
+    x1 = min(left + pixels.shape[1], width)
+    if y0 < y1 and x0 < x1:
+        canvas[y0:y1, x0:x1] = pixels[y0 - top:y1 - top, x0 - left:x1 - left]
+
+
+def pixel_scores(before, after):
+    """Score how much each pair of renderings differs.
+
+    The score is the fraction of the pair's ink which isn't shared, from
+    0 for identical renderings to 1 for renderings which don't overlap.
+
+    Parameters
+    ----------
+    before: np.ndarray
+        (n, height, width) renderings
+    after: np.ndarray
+
+    Returns
+    -------
+    np.ndarray
+        n scores
+    """
+    before = before.astype(np.int32)
+    after = after.astype(np.int32)
+    axes = tuple(range(1, before.ndim))
+    changed = np.abs(before - after).sum(axis=axes)
+    ink = np.maximum(before, after).sum(axis=axes)
+    return changed / np.maximum(ink, 1).astype(np.float64)
+
+
+def diff_glyph_pixels(rasteriser_before, rasteriser_after, names_before,
+                      names_after, batch_size=BATCH_SIZE):
+    """Score the pixel difference of pairs of glyphs.
+
+    Parameters
+    ----------
+    rasteriser_before: GlyphRasteriser
+    rasteriser_after: GlyphRasteriser
+    names_before: list
+    names_after: list
+        names_after[i] is the glyph compared against names_before[i]
+
+    Returns
+    -------
+    np.ndarray
+        A score per pair, see pixel_scores
+    """
+    scores = np.zeros(len(names_before), dtype=np.float64)
+    for start in range(0, len(names_before), batch_size):
+        stop = start + batch_size
+        scores[start:stop] = pixel_scores(
+            rasteriser_before.render(names_before[start:stop]),
+            rasteriser_after.render(names_after[start:stop]))
+    return scores
+
+
+def render_text(path, text, size, width=1200):
+    """Render text, wrapping it to width pixels.
+
+    Returns
+    -------
+    np.ndarray
+        (height, width) coverage from 0 to 255
+    """
+    font = ImageFont.truetype(path, size)
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = word if not line else line + ' ' + word
+            if line and font.getlength(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    line_height = int(size * 1.5)
+    image = Image.new('L', (width, max(line_height * len(lines), 1)), 0)
+    draw = ImageDraw.Draw(image)
+    for idx, line in enumerate(lines):
+        draw.text((0, idx * line_height), line, font=font, fill=255)
+    return np.asarray(image)
+
+
+def render_waterfall(path, text=WATERFALL_TEXT, sizes=WATERFALL_SIZES,
+                     width=1200):
+    """Render text at each point size, one block above the other"""
+    blocks = [render_text(path, text, int(round(pt * 96 / 72.)), width)
+              for pt in sizes]
+    return np.concatenate(blocks, axis=0)
+
+
+def _pad(before, after):
+    """Pad two renderings with blank pixels so they have the same shape"""
+    shape = tuple(max(a, b) for a, b in zip(before.shape, after.shape))
+    padded = []
+    for pixels in (before, after):
+        canvas = np.zeros(shape, dtype=np.uint8)
+        canvas[tuple(slice(0, n) for n in pixels.shape)] = pixels
+        padded.append(canvas)
+    return padded
+
+
+def diff_image(before, after):
+    """Draw two renderings over each other.
+
+    Returns
+    -------
+    (PIL.Image, float)
+        The diff image and its score, see pixel_scores
+    """
+    before, after = _pad(before, after)
+    score = float(pixel_scores(before[np.newaxis], after[np.newaxis])[0])
+    both = np.maximum(before, after)
+    rgb = np.stack([255 - after, 255 - both, 255 - before], axis=-1)
+    return Image.fromarray(rgb.astype(np.uint8)), score
+
+
+def contact_sheet(images, columns=16):
+    """Tile same size images into rows of columns"""
+    width, height = images[0].size
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new('RGB', (width * min(columns, len(images)), height * rows),
+                      (255, 255, 255))
+    for idx, image in enumerate(images):
+        sheet.paste(image, ((idx % columns) * width, (idx // columns) * height))
+    return sheet
@@ -0,0 +1,218 @@
+"""Convert diffenator's diffs into records which can be stored as json.
+
+Diff items are dicts whose values can be diffenator Glyph objects. Each
+Glyph is converted into a plain dict of its attributes, without the
+DFont it references. Inputs are never modified, so the diffenator
+objects stay usable after they have been serialised.
+
+dumps and loads use orjson or msgpack if they are installed, otherwise
+the json module.
+
+Items can also be stored as columns, see encode_columns and
+ColumnarItems.
+"""
+import json
+from collections.abc import Sequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = [
+    'serialise_diff',
+    'serialise_item',
+    'dumps',
+    'loads',
+    'encode_columns',
+    'ColumnarItems',
+]
+
+_PRIMITIVE, _GLYPH, _DICT, _LIST, _OBJECT = range(5)
+# Tuples are left as they are, they only hold the strings of an
+# opentype feature
+_PRIMITIVES = (str, int, float, bool, type(None), tuple)
+# {type: kind}. Filled as new types are seen so each value only costs a
+# dict lookup.
+_kinds = {t: _PRIMITIVE for t in _PRIMITIVES}
+
+
+def serialise_diff(diff):
+    """Return a copy of a diff dict with its items serialised.
+
+    Parameters
+    ----------
+    diff: dict
+        {'uuid': str, 'view': str, ..., 'items': [dict, ...]}
+
+    Returns
+    -------
+    dict
+    """
+    serialised = dict(diff)
+    if 'items' in diff:
+        serialised['items'] = [serialise_item(i) for i in diff['items']]
+    return serialised
+
+
+def serialise_item(item):
+    """Return a copy of a diff item with its Glyphs replaced by dicts"""
+    record = dict(item)
+    kinds = _kinds
+    for k, v in item.items():
+        if kinds.get(type(v)) != _PRIMITIVE:
+            record[k] = _serialise(v)
+    return record
+
+
+def _kind(value):
+    cls = type(value)
+    try:
+        return _kinds[cls]
+    except KeyError:
+        pass
+    if issubclass(cls, _PRIMITIVES):
+        kind = _PRIMITIVE
+    elif issubclass(cls, dict):
+        kind = _DICT
+    elif issubclass(cls, list):
+        kind = _LIST
+    elif hasattr(value, 'key') and hasattr(value, 'font'):
+        kind = _GLYPH
+    else:
+        kind = _OBJECT
+    _kinds[cls] = kind
+    return kind
+
+
+def _serialise(value):
+    kind = _kind(value)
+    if kind == _PRIMITIVE:
+        return value
+    if kind == _GLYPH:
+        glyph = dict(value.__dict__)
+        del glyph['font']
+        return glyph
+    if kind == _DICT:
+        return serialise_item(value)
+    if kind == _LIST:
+        return [_serialise(v) for v in value]
+    return {k: _serialise(v) for k, v in vars(value).items()
+            if k != 'font'}
+
+
+def dumps(obj, format='json'):
+    """Encode serialised diffs as bytes.
+
+    Parameters
+    ----------
+    obj: object
+    format: str
+        'json' or 'msgpack'
+
+    Returns
+    -------
+    bytes
+    """
+    if format == 'msgpack':
+        if msgpack is None:
+            raise Exception('msgpack is not installed')
+        return msgpack.packb(obj, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def loads(data, format='json'):
+    """Decode bytes created by dumps"""
+    if format == 'msgpack':
+        if msgpack is None:
+            raise Exception('msgpack is not installed')
+        return msgpack.unpackb(data, raw=False)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def encode_columns(items):
+    """Encode serialised items as columns.
+
+    Each item must have the same keys. Dict values, such as serialised
+    Glyphs, are split into a column per key.
+
+    Parameters
+    ----------
+    items: list
+        items returned by serialise_item
+
+    Returns
+    -------
+    (schema, columns) or None
+        schema is a list of key paths, e.g [['glyph', 'name'], ['area']],
+        and columns holds the values of each path in item order. None is
+        returned if the items don't share the same keys.
+    """
+    if not items:
+        return None
+    schema = _schema(items[0])
+    for item in items:
+        if _schema(item) != schema:
+            return None
+    columns = []
+    for path in schema:
+        if len(path) == 1:
+            key = path[0]
+            columns.append([item[key] for item in items])
+        else:
+            key, sub_key = path
+            columns.append([item[key][sub_key] for item in items])
+    return schema, columns
+
+
+def _schema(item):
+    schema = []
+    for k, v in item.items():
+        if isinstance(v, dict):
+            schema.extend([k, sub_key] for sub_key in v)
+        else:
+            schema.append([k])
+    return schema
+
+
+class ColumnarItems(Sequence):
+    """Read only sequence of items encoded by encode_columns.
+
+    Items are only decoded when they are accessed. Slicing returns
+    another ColumnarItems without decoding anything.
+
+    Parameters
+    ----------
+    schema: list
+    columns: list
+    """
+    def __init__(self, schema, columns):
+        self.schema = schema
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ColumnarItems(self.schema, [c[index] for c in self.columns])
+        item = {}
+        for path, column in zip(self.schema, self.columns):
+            if len(path) == 1:
+                item[path[0]] = column[index]
+            else:
+                item.setdefault(path[0], {})[path[1]] = column[index]
+        return item
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
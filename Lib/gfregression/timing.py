@@ -0,0 +1,55 @@
+"""Timers for the stages of the diff pipeline.
+
+Stages are wrapped in timed(). Each timing is passed to the registered
+listeners, which e.g the benchmark uses to break a run down by stage.
+
+    >>> with record() as times:
+    ...     with timed('diff'):
+    ...         pass
+    >>> list(times)
+    ['diff']
+"""
+import time
+from contextlib import contextmanager
+
+_listeners = []
+
+
+def add_listener(listener):
+    """Register a callable which is called with (stage, seconds) each time
+    a timed stage finishes"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+@contextmanager
+def timed(stage):
+    """Time the enclosed block and report it to the listeners as stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for listener in list(_listeners):
+            listener(stage, elapsed)
+
+
+class StageTimes(dict):
+    """Listener which sums the seconds spent in each stage"""
+
+    def __call__(self, stage, elapsed):
+        self[stage] = self.get(stage, 0) + elapsed
+
+
+@contextmanager
+def record():
+    """Collect the stage timings of the enclosed block in a StageTimes"""
+    times = StageTimes()
+    add_listener(times)
+    try:
+        yield times
+    finally:
+        remove_listener(times)
@@ -0,0 +1,83 @@
+"""Index of the words in the Universal Declaration of Human Rights.
+
+UDHR has been chosen due to the many languages it covers. The index is
+built the first time it is needed and kept for the life of the process,
+see udhr_index()."""
+from collections import defaultdict
+import os
+
+UDHR_PATH = os.path.join(os.path.dirname(__file__), "udhr_all.txt")
+
+_index = None
+
+
+class UDHRIndex:
+    """Words of a corpus indexed by their codepoints.
+
+    Words which use the same set of codepoints as an earlier word are
+    dropped since they can never add new characters to a selection.
+
+    Parameters
+    ----------
+    text: str
+        corpus of words separated by whitespace
+    """
+    def __init__(self, text):
+        self.words = []
+        self.codepoints = []
+        seen = set()
+        for word in text.split():
+            codepoints = frozenset(ord(c) for c in word)
+            if codepoints in seen:
+                continue
+            seen.add(codepoints)
+            self.words.append(word)
+            self.codepoints.append(codepoints)
+
+        self.by_codepoint = defaultdict(list)
+        for idx, codepoints in enumerate(self.codepoints):
+            for codepoint in codepoints:
+                self.by_codepoint[codepoint].append(idx)
+        self.all_codepoints = frozenset(self.by_codepoint)
+
+    def font_words(self, cmap):
+        """Collect words, in corpus order, which can be formed using the
+        codepoints in cmap. Words whose codepoints have all been covered by
+        previous words are skipped.
+
+        Parameters
+        ----------
+        cmap: iterable
+            codepoints supported by a font
+
+        Returns
+        -------
+        words: list
+        """
+        cmap = set(cmap)
+        blocked = set()
+        for codepoint in self.all_codepoints - cmap:
+            blocked.update(self.by_codepoint[codepoint])
+        candidates = sorted(set(range(len(self.words))) - blocked)
+        coverable = len(self.all_codepoints & cmap)
+
+        words = []
+        seen_chars = set()
+        for idx in candidates:
+            chars = self.codepoints[idx]
+            if chars <= seen_chars:
+                continue
+            seen_chars |= chars
+            words.append(self.words[idx])
+            if len(seen_chars) == coverable:
+                break
+        return words
+
+
+def udhr_index():
+    """Return the process's UDHRIndex, building it on first use"""
+    global _index
+    if _index is None:
+        with open(UDHR_PATH, "r") as doc:
+            _index = UDHRIndex(doc.read())
+    return _index
@@ -0,0 +1,184 @@
+"""Diff variable fonts at locations in their designspace.
+
+When both families are VFs, each named instance is diffed at its fvar
+coordinates. A grid of intermediate locations can also be diffed, see
+grid_locations. When a VF is diffed against a static font, the VF is
+diffed at the static font's weight and width, see static_location.
+
+Instantiating a VF is one of the slowest parts of a diff, so each
+location is only instanced once per upload, see InstanceCache.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from itertools import product
+from diffenator.font import DFont, WIDTH_CLASS_TO_FVAR
+from fontTools.ttLib import TTFont
+from fontTools.varLib.instancer import instantiateVariableFont
+from gfregression.timing import timed
+
+__all__ = [
+    'grid_locations',
+    'location_name',
+    'static_location',
+    'InstanceCache',
+    'instance_cache',
+]
+
+# Bytes of instance files whose DFonts are kept in memory by each
+# InstanceCache
+INSTANCE_CACHE_SIZE = 256 * 1024 ** 2
+
+# {directory: InstanceCache} for the current process, see instance_cache
+_caches = {}
+
+
+def grid_locations(axes_before, axes_after, steps):
+    """Return evenly spaced locations across the axes shared by two VFs.
+
+    Each axis is sampled at steps points between the largest minimum and
+    smallest maximum of the two fonts, so a font with n shared axes has
+    steps ** n locations.
+
+    Parameters
+    ----------
+    axes_before: dict
+        {axis tag: fvar axis}, see Font.axes
+    axes_after: dict
+    steps: int
+
+    Returns
+    -------
+    list
+        [{axis tag: value}, ...]
+    """
+    if steps < 2:
+        return []
+    ranges = []
+    for tag in sorted(set(axes_before) & set(axes_after)):
+        lo = max(axes_before[tag].minValue, axes_after[tag].minValue)
+        hi = min(axes_before[tag].maxValue, axes_after[tag].maxValue)
+        if lo >= hi:
+            continue
+        values = [round(lo + (hi - lo) * i / float(steps - 1), 2)
+                  for i in range(steps)]
+        ranges.append([(tag, v) for v in values])
+    if not ranges:
+        return []
+    return [dict(location) for location in product(*ranges)]
+
+
+def location_name(location, italic=False):
+    """Style name for a location e.g wdth87_5-wght450. Names are used as
+    css class names so they can't contain dots."""
+    name = '-'.join(('%s%g' % (tag, location[tag])).replace('.', '_')
+                    for tag in sorted(location))
+    return 'Italic-' + name if italic else name
+
+
+def static_location(ttfont, axes):
+    """Return the location of a VF which matches a static font's weight and
+    width classes, the same location as diffenator's
+    DFont.set_variations_from_static.
+
+    Parameters
+    ----------
+    ttfont: TTFont
+        static font
+    axes: dict
+        {axis tag: fvar axis} of the VF, see Font.axes
+    """
+    location = {
+        'wght': ttfont['OS/2'].usWeightClass,
+        'wdth': WIDTH_CLASS_TO_FVAR[ttfont['OS/2'].usWidthClass],
+    }
+    return {tag: min(max(value, axes[tag].minValue), axes[tag].maxValue)
+            for tag, value in location.items() if tag in axes}
+
+
+class InstanceCache:
+    """Static instances of VFs keyed by the VF's path and location.
+
+    Each instance is made once and saved as a font file in directory,
+    which every process using the directory shares. The DFonts opened
+    from the files are kept in memory until the size of their files
+    exceeds max_size, then the least recently used DFonts are dropped.
+    Dropped instances are reopened from their file, without instancing
+    the VF again.
+
+    Static fonts, whose location is None, are cached the same way.
+
+    Parameters
+    ----------
+    directory: str
+    max_size: int
+        Approximate memory budget in bytes. DFonts are measured by the size
+        of their font file.
+    """
+    def __init__(self, directory, max_size=INSTANCE_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._fonts = OrderedDict()
+        self._size = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, vf_path, location):
+        """Return the path of a VF's instance at location. The VF is
+        instanced if no process has instanced the location before."""
+        if location is None:
+            return vf_path
+        key = repr((os.path.abspath(vf_path), sorted(location.items())))
+        path = os.path.join(
+            self.directory,
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.ttf')
+        if os.path.isfile(path):
+            return path
+        with timed('instantiate'):
+            vf = TTFont(vf_path)
+            # Axes missing from location are pinned at their default so
+            # the instance is always static
+            full_location = {a.axisTag: a.defaultValue for a in vf['fvar'].axes}
+            full_location.update((tag, value) for tag, value in location.items()
+                                 if tag in full_location)
+            instance = instantiateVariableFont(vf, full_location)
+            # Other processes may read the file as soon as it exists
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as doc:
+                instance.save(doc)
+            os.replace(tmp_path, path)
+        return path
+
+    def font(self, vf_path, location):
+        """Return a DFont of a VF's instance at location, or of a static
+        font if location is None"""
+        key = (vf_path,
+               None if location is None else tuple(sorted(location.items())))
+        if key in self._fonts:
+            self._fonts.move_to_end(key)
+            self.hits += 1
+            return self._fonts[key][0]
+        self.misses += 1
+        path = self.path(vf_path, location)
+        with timed('parse_font'):
+            font = DFont(path)
+        size = os.path.getsize(path)
+        self._fonts[key] = (font, size)
+        self._size += size
+        while self._size > self.max_size and len(self._fonts) > 1:
+            _, (_, evicted_size) = self._fonts.popitem(last=False)
+            self._size -= evicted_size
+        return font
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def instance_cache(directory, max_size=INSTANCE_CACHE_SIZE):
+    """Return the current process' InstanceCache for a directory. Used by
+    process pool workers, which can't be passed the parent's cache."""
+    if directory not in _caches:
+        _caches[directory] = InstanceCache(directory, max_size)
+    return _caches[directory]
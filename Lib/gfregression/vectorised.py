@@ -0,0 +1,164 @@
+"""Vectorised glyph and metrics diffs.
+
+fontdiffenator compares the glyphs and metrics tables of two fonts one
+glyph at a time in python. For fonts with tens of thousands of glyphs,
+these functions put each table's values into numpy arrays, keyed by
+glyph key, and find the modified glyphs with array operations. Rows are
+only built for the glyphs which have changed.
+
+The results have the same shape as diffenator's DiffFonts.glyphs and
+DiffFonts.metrics, so they can be stored in DiffFonts._data.
+"""
+import numpy as np
+from diffenator import DiffTable
+
+__all__ = ['GlyphArrays', 'diff_glyphs', 'diff_metrics']
+
+
+class GlyphArrays:
+    """A DFont's glyphs and metrics tables as arrays.
+
+    Rows are keyed by their glyph's key, the glyph's characters and
+    features. As in diffenator, the last row is kept if several rows
+    share a key.
+
+    Parameters
+    ----------
+    font: DFont
+    glyphs: list
+        Rows to use instead of font.glyphs
+    metrics: list
+        Rows to use instead of font.metrics
+    """
+    def __init__(self, font, glyphs=None, metrics=None):
+        self.font = font
+        self.upm = font.ttfont['head'].unitsPerEm
+        glyphs = font.glyphs if glyphs is None else glyphs
+        metrics = font.metrics if metrics is None else metrics
+
+        glyphs = {row['glyph'].key: row for row in glyphs}
+        self.glyph_rows = list(glyphs.values())
+        self.glyph_keys = list(glyphs)
+        self.area = np.abs(np.array(
+            [row['area'] for row in self.glyph_rows], dtype=np.float64))
+
+        metrics = {row['glyph'].key: row for row in metrics}
+        self.metrics_rows = list(metrics.values())
+        self.metrics_keys = list(metrics)
+        # lsb and rsb are the horizontal extents of each glyph's bounding
+        # box, relative to its advance
+        self.adv, self.lsb, self.rsb = np.array(
+            [(row['adv'], row['lsb'], row['rsb']) for row in self.metrics_rows],
+            dtype=np.float64).reshape(-1, 3).T
+
+
+def _align(keys_before, keys_after):
+    """Return the indexes of the shared keys in each list of keys, and
+    the indexes of the keys which are only in one of them"""
+    index_after = {k: i for i, k in enumerate(keys_after)}
+    shared_before = []
+    shared_after = []
+    missing = []
+    for i, key in enumerate(keys_before):
+        if key in index_after:
+            shared_before.append(i)
+            shared_after.append(index_after[key])
+        else:
+            missing.append(i)
+    shared = set(shared_after)
+    new = [i for i in range(len(keys_after)) if i not in shared]
+    return (np.array(shared_before, dtype=np.intp),
+            np.array(shared_after, dtype=np.intp),
+            missing, new)
+
+
+def diff_glyphs(arrays_before, arrays_after, thresh=0):
+    """Find new, missing and modified glyphs.
+
+    A glyph is modified if the ratio between the surface areas of the
+    before and after glyph differs by more than thresh.
+
+    Parameters
+    ----------
+    arrays_before: GlyphArrays
+    arrays_after: GlyphArrays
+    thresh: float
+
+    Returns
+    -------
+    dict
+        {"new": DiffTable, "missing": DiffTable, "modified": DiffTable}
+    """
+    font_before, font_after = arrays_before.font, arrays_after.font
+    shared_before, shared_after, missing, new = _align(
+        arrays_before.glyph_keys, arrays_after.glyph_keys)
+
+    area_before = arrays_before.area[shared_before]
+    area_after = arrays_after.area[shared_after]
+    smallest = np.minimum(area_before, area_after)
+    largest = np.maximum(area_before, area_after)
+    # Whitespace glyphs have no area in either font
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = np.where(largest == 0, 0, 1 - smallest / largest)
+    changed = np.flatnonzero(diff > thresh)
+
+    modified = [dict(arrays_before.glyph_rows[shared_before[i]],
+                     diff=round(float(diff[i]), 4))
+                for i in changed]
+    new = [arrays_after.glyph_rows[i] for i in new]
+    missing = [arrays_before.glyph_rows[i] for i in missing]
+
+    new = DiffTable("glyphs new", font_before, font_after, data=new,
+                    renderable=True)
+    new.report_columns(["glyph", "area", "string"])
+    new.sort(key=lambda k: k["glyph"].name)
+
+    missing = DiffTable("glyphs missing", font_before, font_after,
+                        data=missing, renderable=True)
+    missing.report_columns(["glyph", "area", "string"])
+    missing.sort(key=lambda k: k["glyph"].name)
+
+    modified = DiffTable("glyphs modified", font_before, font_after,
+                         data=modified, renderable=True)
+    modified.report_columns(["glyph", "diff", "string"])
+    modified.sort(key=lambda k: abs(k["diff"]), reverse=True)
+    return {'new': new, 'missing': missing, 'modified': modified}
+
+
+def diff_metrics(arrays_before, arrays_after, thresh=0):
+    """Find glyphs whose advance width has changed by more than thresh.
+
+    The after advances are scaled to the before font's upm.
+
+    Parameters
+    ----------
+    arrays_before: GlyphArrays
+    arrays_after: GlyphArrays
+    thresh: float
+
+    Returns
+    -------
+    dict
+        {"modified": DiffTable}
+    """
+    shared_before, shared_after, _, _ = _align(
+        arrays_before.metrics_keys, arrays_after.metrics_keys)
+    scale = arrays_before.upm / float(arrays_after.upm)
+
+    adv_before = arrays_before.adv[shared_before]
+    adv_after = arrays_after.adv[shared_after] * scale
+    diff_adv = np.abs(adv_after - adv_before)
+    diff_lsb = arrays_after.lsb[shared_after] - arrays_before.lsb[shared_before]
+    diff_rsb = arrays_after.rsb[shared_after] - arrays_before.rsb[shared_before]
+    changed = np.flatnonzero(diff_adv > thresh)
+
+    modified = [dict(arrays_before.metrics_rows[shared_before[i]],
+                     diff_adv=float(diff_adv[i]),
+                     diff_lsb=float(diff_lsb[i]),
+                     diff_rsb=float(diff_rsb[i]))
+                for i in changed]
+    modified = DiffTable("metrics modified", arrays_before.font,
+                         arrays_after.font, data=modified, renderable=True)
+    modified.report_columns(["glyph", "diff_adv"])
+    modified.sort(key=lambda k: k["diff_adv"], reverse=True)
+    return {'modified': modified}
@@ -0,0 +1,167 @@
+"""RethinkDB connection pool.
+
+Each uWSGI worker process keeps its own bounded pool of connections which
+are reused between requests, see pool()."""
+import os
+import threading
+import time
+from queue import LifoQueue, Empty
+import rethinkdb as r
+from rethinkdb.errors import ReqlError, RqlDriverError
+from settings import (
+    RDB_HOST,
+    RDB_PORT,
+    DB,
+    RDB_POOL_SIZE,
+    RDB_POOL_TIMEOUT,
+    RDB_POOL_CHECK_INTERVAL,
+)
+
+__all__ = ['ConnectionPool', 'pool']
+
+
+class ConnectionPool:
+    """Bounded pool of rethinkdb connections.
+
+    Connections are opened lazily, up to size. Once they are all in use,
+    acquire waits up to timeout seconds for one to be released. Idle
+    connections which haven't been used for check_interval seconds are
+    checked before they are handed out and reconnected if they have gone
+    stale.
+
+    Parameters
+    ----------
+    host: str
+    port: int
+    db: str
+    size: int
+        max number of open connections
+    timeout: float
+        seconds to wait for a connection when the pool is exhausted
+    check_interval: float
+        seconds a connection can be idle before it is health checked
+    """
+    def __init__(self, host, port, db, size=10, timeout=10,
+                 check_interval=30):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+
+        self.acquired = 0
+        self.wait_time = 0.
+        self.exhausted = 0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def acquire(self):
+        """Return a connection from the pool, opening one if needed"""
+        start = time.time()
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except Empty:
+            conn, last_used = self._open_or_wait()
+        if last_used and time.time() - last_used > self.check_interval:
+            conn = self._check(conn)
+        self.acquired += 1
+        self.wait_time += time.time() - start
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool. Closed connections are
+        discarded."""
+        if conn.is_open():
+            self._idle.put((conn, time.time()))
+        else:
+            self.discard(conn)
+
+    def discard(self, conn):
+        """Close a connection and free its slot in the pool"""
+        try:
+            conn.close(noreply_wait=False)
+        except ReqlError:
+            pass
+        with self._lock:
+            self._open -= 1
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'open': self._open,
+            'idle': self._idle.qsize(),
+            'acquired': self.acquired,
+            'wait_time': self.wait_time,
+            'exhausted': self.exhausted,
+            'timeouts': self.timeouts,
+            'reconnects': self.reconnects,
+        }
+
+    def _open_or_wait(self):
+        with self._lock:
+            can_open = self._open < self.size
+            if can_open:
+                self._open += 1
+        if can_open:
+            try:
+                return self._connect(), None
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                raise
+
+        self.exhausted += 1
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Empty:
+            self.timeouts += 1
+            raise Exception(
+                "No database connection became free within {}s".format(
+                    self.timeout))
+
+    def _connect(self):
+        try:
+            return r.connect(host=self.host, port=self.port, db=self.db)
+        except RqlDriverError:
+            raise Exception("No database connection could be established.")
+
+    def _check(self, conn):
+        try:
+            r.expr(1).run(conn)
+            return conn
+        except ReqlError:
+            self.reconnects += 1
+        try:
+            return conn.reconnect(noreply_wait=False)
+        except (ReqlError, OSError):
+            # The database is still unreachable. Free the connection's
+            # slot, then open a new connection or raise.
+            self.discard(conn)
+            return self._open_or_wait()[0]
+
+
+_pool = None
+_pool_pid = None
+
+
+def pool():
+    """Return the current process's pool.
+
+    uWSGI forks its workers after the app is imported so the pool is
+    created on first use in each process rather than at import."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ConnectionPool(
+            RDB_HOST,
+            RDB_PORT,
+            DB,
+            size=RDB_POOL_SIZE,
+            timeout=RDB_POOL_TIMEOUT,
+            check_interval=RDB_POOL_CHECK_INTERVAL,
+        )
+        _pool_pid = os.getpid()
+    return _pool
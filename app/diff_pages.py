@@ -0,0 +1,188 @@
+"""Paged storage of diffs in the families_diffs table.
+
+A style's diff for a view can contain thousands of items, e.g
+glyphs_all for a CJK family. Rather than storing each diff as a single
+document, its items are split into pages of DIFF_PAGE_SIZE items. Each
+page is stored as a copy of the diff with the following extra fields:
+
+    'items': the page's items
+    'page': page number, starting at 0
+    'item_count': number of items in the whole diff
+
+If DIFF_COLUMNAR is set, 'items' is replaced by 'schema' and 'columns',
+see gfregression.serialise.encode_columns. Items which are stored as
+columns are returned by fetch() as a ColumnarItems, which only decodes
+the items the templates access.
+
+Views only fetch the items which they display, see fetch()."""
+import rethinkdb as r
+from gfregression.serialise import dumps, encode_columns, ColumnarItems
+from settings import DIFF_PAGE_SIZE, DIFF_COLUMNAR
+
+__all__ = ['paginate', 'insert', 'fetch', 'fetch_all', 'changed_views']
+
+# Number of pages sent to rethinkdb in each insert query
+INSERT_BATCH_SIZE = 50
+
+
+def paginate(diffs, page_size=DIFF_PAGE_SIZE, columnar=DIFF_COLUMNAR):
+    """Split each diff's items into pages.
+
+    Diffs without items, such as the text view, are stored as a single
+    page.
+
+    Parameters
+    ----------
+    diffs: list
+        diffs returned by diff_families, families_glyphs_all etc
+    page_size: int
+    columnar: bool
+        Store items as columns. Diffs whose items don't share the same
+        keys are stored as rows.
+
+    Returns
+    -------
+    pages: list
+    """
+    pages = []
+    for diff in diffs:
+        items = diff.get('items')
+        if not items:
+            pages.append(dict(diff, page=0, item_count=0))
+            continue
+        encoded = encode_columns(items) if columnar else None
+        for page, start in enumerate(range(0, len(items), page_size)):
+            stop = start + page_size
+            if encoded:
+                schema, columns = encoded
+                page_doc = dict(diff, schema=schema,
+                                columns=[c[start:stop] for c in columns])
+                del page_doc['items']
+            else:
+                page_doc = dict(diff, items=items[start:stop])
+            page_doc.update(page=page, item_count=len(items))
+            pages.append(page_doc)
+    return pages
+
+
+def insert(conn, diffs):
+    """Store diffs as pages.
+
+    The pages are sent as a json string. Given python objects, the driver
+    builds a query term for every value, which is far slower than
+    encoding the json."""
+    pages = paginate(diffs)
+    for start in range(0, len(pages), INSERT_BATCH_SIZE):
+        batch = dumps(pages[start:start + INSERT_BATCH_SIZE])
+        r.table('families_diffs').insert(
+            r.json(batch.decode('utf-8'))).run(conn)
+
+
+def fetch(conn, uuid, view, styles, start, stop):
+    """Return the items start to stop of each style's diff for a view.
+
+    Only the pages which contain the items are read and they are sliced
+    by rethinkdb, so the amount transferred doesn't depend on the size of
+    the diffs.
+
+    Parameters
+    ----------
+    conn: rethinkdb connection
+    uuid: str
+    view: str
+    styles: list
+        font_before style names to fetch
+    start: int
+    stop: int
+
+    Returns
+    -------
+    diffs: list
+        One diff per style, in the order of styles. Each diff's items are
+        its items start to stop and its item_count is the number of items
+        in the whole diff.
+    """
+    first_page = start // DIFF_PAGE_SIZE
+    last_page = max(first_page, (stop - 1) // DIFF_PAGE_SIZE)
+    keys = [[uuid, view, style, page]
+            for style in styles
+            for page in range(first_page, last_page + 1)]
+    pages = []
+    if keys:
+        pages = list(r.table('families_diffs')
+            .get_all(*keys, index='uuid_view_style_page')
+            .merge(lambda page: _slice_page(page, start, stop))
+            .run(conn))
+    if not pages:
+        # Diffs stored before paging was added are whole documents
+        pages = list(r.table('families_diffs')
+            .get_all([uuid, view], index='uuid_view')
+            .filter(lambda diff: diff.has_fields('page').not_())
+            .run(conn))
+        pages = [dict(p, items=p.get('items', [])[start:stop])
+                 for p in pages if p['font_before'] in styles]
+    return _merge(pages, styles)
+
+
+def fetch_all(conn, uuid, view, styles):
+    """Return every item of each style's diff for a view, in the order of
+    styles. Items stored as columns are decoded."""
+    pages = r.table('families_diffs').get_all(
+        [uuid, view], index='uuid_view').run(conn)
+    diffs = _merge([p for p in pages if p['font_before'] in styles], styles)
+    for diff in diffs:
+        diff['items'] = list(diff['items'])
+    return diffs
+
+
+def _slice_page(page, start, stop):
+    """Query which slices a page's items, or columns, to the ones between
+    start and stop"""
+    offset = page['page'] * DIFF_PAGE_SIZE
+    page_start = r.branch(offset.lt(start), r.expr(start) - offset, 0)
+    page_stop = r.expr(stop) - offset
+    return r.branch(
+        page.has_fields('columns'),
+        {'columns': page['columns'].map(
+            lambda column: column.slice(page_start, page_stop))},
+        {'items': page['items'].default([]).slice(page_start, page_stop)},
+    )
+
+
+def _merge(pages, styles):
+    diffs = {}
+    for page in sorted(pages, key=lambda p: p.get('page', 0)):
+        style = page['font_before']
+        if style not in diffs:
+            diffs[style] = dict(page, items=[])
+            for key in ('page', 'id', 'schema', 'columns'):
+                diffs[style].pop(key, None)
+            if 'columns' in page:
+                diffs[style]['items'] = ColumnarItems(
+                    page['schema'], [[] for _ in page['schema']])
+        if 'columns' in page:
+            for column, page_column in zip(diffs[style]['items'].columns,
+                                           page['columns']):
+                column += page_column
+        else:
+            diffs[style]['items'] += page.get('items', [])
+    for diff in diffs.values():
+        if 'item_count' not in diff:
+            diff['item_count'] = len(diff['items'])
+    return [diffs[s] for s in styles if s in diffs]
+
+
+def changed_views(conn, uuid):
+    """Return the views which have at least one diff item"""
+    counts = (r.table('families_diffs')
+        .get_all(uuid, index='uuid')
+        .map(lambda diff: {
+            'view': diff['view'],
+            'count': diff['item_count'].default(
+                diff['items'].count().default(0)),
+        })
+        .filter(lambda diff: diff['count'] > 0)
+        .pluck('view')
+        .distinct()
+        .run(conn))
+    return [c['view'] for c in counts]
@@ -1,10 +1,39 @@
-"""Setup rethinkdb for diffenator"""
+"""Setup rethinkdb for diffenator
+
+Running this module creates any missing tables and secondary indexes.
+Existing deployments can be migrated with:
+
+    python init_db.py
+"""
 from __future__ import print_function
 import rethinkdb as r
 
 __all__ = ['build_tables']
 
 
+TABLES = ('families', 'families_diffs', 'glyph_hashes', 'jobs')
+
+# {table: [(index_name, index_function), ...]}. An index function of None
+# indexes the field with the same name as the index.
+INDEXES = {
+    'families': [
+        ('uuid', None),
+    ],
+    'families_diffs': [
+        ('uuid', None),
+        ('uuid_view', lambda row: [row['uuid'], row['view']]),
+        ('uuid_view_style_page', lambda row: [
+            row['uuid'], row['view'], row['font_before'], row['page']]),
+    ],
+    'glyph_hashes': [
+        ('uuid', None),
+    ],
+    'jobs': [
+        ('status', None),
+    ],
+}
+
+
 def build_tables(host, port, db):
     connection = r.connect(host=host, port=port, db=db).repl()
     try:
@@ -12,11 +41,39 @@ def build_tables(host, port, db):
     except r.errors.ReqlOpFailedError:
         print('Skipping db creation, it already exists')
 
-    for table in ('families', 'families_diffs'):
+    for table in TABLES:
         try:
             r.db(db).table_create(table).run()
             print('Created %s table' % table)
         except r.errors.ReqlOpFailedError:
             print('Skipping %s table creation, they already exist' % table)
 
+    build_indexes(db)
     connection.close()
+
+
+def build_indexes(db):
+    """Create any missing secondary indexes and wait until they are ready.
+    Indexes created for tables which already contain documents will be
+    built from the existing documents."""
+    for table in TABLES:
+        existing = r.db(db).table(table).index_list().run()
+        for name, func in INDEXES.get(table, []):
+            if name in existing:
+                continue
+            # Another process may create the index after index_list
+            try:
+                if func:
+                    r.db(db).table(table).index_create(name, func).run()
+                else:
+                    r.db(db).table(table).index_create(name).run()
+                print('Created %s index on %s table' % (name, table))
+            except r.errors.ReqlOpFailedError:
+                print('Skipping %s index creation on %s table, it already '
+                      'exists' % (name, table))
+        r.db(db).table(table).index_wait().run()
+
+
+if __name__ == '__main__':
+    from settings import RDB_HOST, RDB_PORT, DB
+    build_tables(host=RDB_HOST, port=RDB_PORT, db=DB)
@@ -0,0 +1,243 @@
+"""Upload job queue.
+
+Uploads are stored in the jobs table and diffed by the processes started
+in worker.py. Each job's progress is written to its families document so
+the compare and api views can report it while the job is running."""
+import hashlib
+import os
+import shutil
+import traceback
+import rethinkdb as r
+from gfregression import (
+    family_from_paths,
+    family_from_googlefonts,
+    FamilyComparison,
+    families_stylesheet,
+)
+from gfregression.cache import DiffCache
+from gfregression.incremental import INCREMENTAL_VIEWS
+from gfregression.timing import timed, record
+import metrics
+import diff_pages
+from utils import secret
+from settings import (
+    DIFF_FAMILIES,
+    DIFF_WORKERS,
+    VF_GRID_STEPS,
+    DIFF_CACHE_DIR,
+    DIFF_CACHE_SIZE,
+    FONTS_DIR,
+    MEDIA_DIR,
+    RENDER_DIFFS,
+    STYLESHEETS_DIR,
+    UPLOADS_DIR,
+)
+
+__all__ = ['enqueue', 'claim', 'requeue_stale', 'run']
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_diff_cache = None
+
+
+def get_diff_cache():
+    """Return the job worker's DiffCache. It is made on first use so
+    processes which only import this module, e.g the app, don't create
+    DIFF_CACHE_DIR."""
+    global _diff_cache
+    if _diff_cache is None:
+        _diff_cache = DiffCache(DIFF_CACHE_DIR, DIFF_CACHE_SIZE)
+    return _diff_cache
+
+
+def staging_dir(uuid, position):
+    """Directory which holds an upload's fonts until its job has run"""
+    path = os.path.join(UPLOADS_DIR, uuid, position)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def enqueue(conn, uuid, upload_type, fonts_before, fonts_after,
+            previous_uuid=None):
+    """Add an upload to the queue.
+
+    Parameters
+    ----------
+    conn: rethinkdb connection
+    uuid: str
+    upload_type: str
+        'googlefonts' or 'user'
+    fonts_before: list
+        Paths to the staged before fonts. Ignored for googlefonts uploads.
+    fonts_after: list
+        Paths to the staged after fonts
+    previous_uuid: str
+        uuid of a previous upload of the family. Only the glyphs which
+        have changed since are diffed, see previous_results.
+    """
+    r.table('families').insert({
+        'uuid': uuid,
+        'status': PENDING,
+        'stage': 'queued',
+        'progress': 0,
+    }).run(conn)
+    r.table('jobs').insert({
+        'id': uuid,
+        'status': PENDING,
+        'upload_type': upload_type,
+        'fonts_before': fonts_before,
+        'fonts_after': fonts_after,
+        'previous_uuid': previous_uuid,
+        'created': r.now(),
+    }).run(conn)
+
+
+def claim(conn):
+    """Mark the oldest pending job as running and return it. Return None if
+    the queue is empty or another worker claimed the job first."""
+    result = (r.table('jobs')
+        .get_all(PENDING, index='status')
+        .order_by('created')
+        .limit(1)
+        .update(lambda job: r.branch(
+            job['status'] == PENDING,
+            {'status': RUNNING, 'started': r.now()},
+            {}),
+            return_changes=True)
+        .run(conn))
+    if not result['replaced']:
+        return None
+    return result['changes'][0]['new_val']
+
+
+def requeue_stale(conn):
+    """Return jobs which were running when the workers were stopped back to
+    the queue. Their staged fonts are only removed once a job has finished,
+    and _run removes the results of the unfinished run."""
+    r.table('jobs').get_all(RUNNING, index='status').update(
+        {'status': PENDING}).run(conn)
+
+
+def progress(conn, uuid, stage, amount, status=RUNNING):
+    """Update the progress fields of a job's families document"""
+    r.table('families').get_all(uuid, index='uuid').update({
+        'status': status,
+        'stage': stage,
+        'progress': amount,
+    }).run(conn)
+
+
+def run(conn, job):
+    """Diff a job's families and store the results"""
+    uuid = job['id']
+    try:
+        _run(conn, job)
+    except Exception:
+        metrics.observe_job(FAILED)
+        r.table('jobs').get(uuid).update({'status': FAILED}).run(conn)
+        r.table('families').get_all(uuid, index='uuid').update({
+            'status': FAILED,
+            'error': traceback.format_exc(),
+        }).run(conn)
+    else:
+        metrics.observe_job(DONE)
+        r.table('jobs').get(uuid).update({'status': DONE}).run(conn)
+    finally:
+        shutil.rmtree(os.path.join(UPLOADS_DIR, uuid), ignore_errors=True)
+
+
+def previous_results(conn, uuid):
+    """Return the glyph hashes and diffs of a previous upload in the
+    form expected by diff_families' previous parameter"""
+    previous = {}
+    for doc in r.table('glyph_hashes').get_all(uuid, index='uuid').run(conn):
+        previous[doc['style']] = {
+            'font_before': doc['font_before'],
+            'hashes': doc['hashes'],
+            'diffs': {},
+        }
+    for view in INCREMENTAL_VIEWS:
+        for diff in diff_pages.fetch_all(conn, uuid, view, list(previous)):
+            previous[diff['font_before']]['diffs'][view] = diff['items']
+    return previous
+
+
+def save_stylesheet(uuid, families):
+    """Write an upload's stylesheet to STYLESHEETS_DIR so the compare
+    views link to it rather than templating the css on every request.
+
+    Returns
+    -------
+    str
+        path of the stylesheet relative to static
+    """
+    css = families_stylesheet(families).encode('utf-8')
+    filename = '{}-{}.css'.format(uuid, hashlib.sha1(css).hexdigest()[:12])
+    os.makedirs(STYLESHEETS_DIR, exist_ok=True)
+    with open(os.path.join(STYLESHEETS_DIR, filename), 'wb') as doc:
+        doc.write(css)
+    return 'stylesheets/' + filename
+
+
+def _run(conn, job):
+    uuid = job['id']
+    # The seconds spent in each stage are stored with the families doc.
+    # Stages run by diff_families' worker processes are only included in
+    # its total.
+    with record() as timings:
+        progress(conn, uuid, 'loading fonts', 0)
+        # Results stored by an earlier run of a requeued job
+        r.table('families_diffs').get_all(uuid, index='uuid').delete().run(conn)
+        r.table('glyph_hashes').get_all(uuid, index='uuid').delete().run(conn)
+        # The staged fonts are copied so the job can be run again if its
+        # worker dies
+        family_after = family_from_paths(job['fonts_after'], FONTS_DIR,
+                                         copy=True)
+        if job['upload_type'] == 'googlefonts':
+            progress(conn, uuid, 'downloading fonts', 0.1)
+            family_before = family_from_googlefonts(
+                family_after.name,
+                FONTS_DIR,
+                api_key=secret("GF_API_KEY"),
+                include_width_families=True
+            )
+        else:
+            family_before = family_from_paths(job['fonts_before'], FONTS_DIR,
+                                              copy=True)
+
+        previous = None
+        if DIFF_FAMILIES and job.get('previous_uuid'):
+            with timed('db_read'):
+                previous = previous_results(conn, job['previous_uuid'])
+        media_dir = os.path.join(MEDIA_DIR, uuid) if RENDER_DIFFS else None
+        diff_cache = get_diff_cache()
+        cache_stats = diff_cache.stats()
+        with FamilyComparison(family_before, family_after, uuid,
+                              vf_grid=VF_GRID_STEPS) as comparison:
+            diff, glyph_hashes, families = comparison.run(
+                diff_families=DIFF_FAMILIES,
+                workers=DIFF_WORKERS,
+                cache=diff_cache,
+                previous=previous,
+                media_dir=media_dir,
+                on_stage=lambda stage, amount: progress(conn, uuid, stage,
+                                                        amount),
+            )
+        metrics.observe_cache(
+            'diffs',
+            diff_cache.hits - cache_stats['hits'],
+            diff_cache.misses - cache_stats['misses'],
+        )
+
+        progress(conn, uuid, 'saving diffs', 0.9)
+        with timed('db_write'):
+            diff_pages.insert(conn, diff)
+            if glyph_hashes:
+                r.table('glyph_hashes').insert(glyph_hashes).run(conn)
+        families['stylesheet'] = save_stylesheet(uuid, families)
+    families.update(status=DONE, stage=DONE, progress=1,
+                    timings=dict(timings))
+    r.table('families').get_all(uuid, index='uuid').update(families).run(conn)
@@ -7,58 +7,81 @@ from flask import (
     redirect,
     url_for,
     send_file,
+    Response,
 )
 from werkzeug.useragents import UserAgent
 from uuid import uuid4
+import atexit
 import os
 import json
+import math
+import time
 import rethinkdb as r
-from rethinkdb.errors import RqlDriverError
-from gfregression import (
-    family_from_user_upload,
-    family_from_googlefonts,
-    diff_families,
-    families_glyphs_all,
-    families_text,
-    get_families,
-)
+from gfregression.downloadfonts import user_upload
+from gfregression.timing import timed
 
+import db
+import diff_pages
 import init_db
+import jobs
+import metrics
 from utils import browser_supports_vfs, secret
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    # Not running under uWSGI
+    postfork = None
 from settings import (
+    RDB_HOST,
+    RDB_PORT,
+    DB,
     DIFF_LIMIT,
     VIEWS,
     MEDIA_DIR,
-    DIFF_FAMILIES,
     DEBUG,
-    FONTS_DIR
 )
 
 __version__ = 4.001
 
 app = Flask(__name__, static_url_path='/static')
 
-RDB_HOST = os.environ.get('RDB_HOST') or 'localhost'
-RDB_PORT = os.environ.get('RDB_PORT') or 28015
-DB = 'diffenator_web'
-
 init_db.build_tables(host=RDB_HOST, port=RDB_PORT, db=DB)
+metrics.install()
+
+if postfork:
+    @postfork
+    def mark_worker_dead_at_exit():
+        """uWSGI respawns workers with new pids, so each worker's gauge
+        samples are removed when it exits"""
+        atexit.register(metrics.mark_process_dead, os.getpid())
+
+
+def get_conn():
+    """Return the request's database connection. Connections are only
+    taken from the pool by views which query the database."""
+    if 'rdb_conn' not in g:
+        g.rdb_conn = db.pool().acquire()
+    return g.rdb_conn
 
 
 @app.before_request
 def before_request():
-    try:
-        g.rdb_conn = r.connect(host=RDB_HOST, port=RDB_PORT, db=DB)
-    except RqlDriverError:
-        raise Exception("No database connection could be established.")
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def after_request(response):
+    metrics.observe_request(request.endpoint,
+                            time.perf_counter() - g.request_start)
+    return response
 
 
 @app.teardown_request
 def teardown_request(exception):
-    try:
-        g.rdb_conn.close()
-    except AttributeError:
-        pass
+    conn = g.pop('rdb_conn', None)
+    if conn is not None:
+        db.pool().release(conn)
+    metrics.observe_pool(db.pool().stats())
 
 
 @app.route('/')
@@ -69,7 +92,11 @@ def index():
 @app.route("/api/upload/<upload_type>", methods=['POST'])
 @app.route('/upload-fonts', methods=["POST"])
 def upload_fonts(upload_type=None):
-    """Upload fonts to diff."""
+    """Upload fonts to diff.
+
+    The fonts are staged and queued for a job worker to diff. The response
+    is returned straight away; the compare and api views report the
+    job's progress until it has finished."""
     from_api = False
     if 'api' in request.path:
         upload_type = upload_type
@@ -77,30 +104,21 @@ def upload_fonts(upload_type=None):
     else:
         upload_type = request.form.get('fonts')
 
-    if upload_type == 'googlefonts':
-        family_after = family_from_user_upload(request.files.getlist('fonts_after'),
-                                              FONTS_DIR)
-        family_before = family_from_googlefonts(family_after.name,
-                                                FONTS_DIR,
-                                                api_key=secret("GF_API_KEY"),
-                                                include_width_families=True)
-    elif upload_type == 'user':
-        family_after = family_from_user_upload(request.files.getlist('fonts_after'),
-                                               FONTS_DIR)
-        family_before = family_from_user_upload(request.files.getlist('fonts_before'),
-                                                FONTS_DIR)
-
     uuid = str(uuid4())
-    if DIFF_FAMILIES:
-        diff = diff_families(family_before, family_after, uuid)
-        diff += families_glyphs_all(family_before, family_after, uuid)
-        diff += families_text(family_before, family_after, uuid)
-    else:
-        diff = families_glyphs_all(family_before, family_after, uuid)
-        diff += families_text(family_before, family_after, uuid)
-    r.table('families_diffs').insert(diff).run(g.rdb_conn)
-    families = get_families(family_before, family_after, uuid)
-    r.table('families').insert(families).run(g.rdb_conn)
+    with timed('stage_upload'):
+        if upload_type == 'googlefonts':
+            fonts_before = []
+        elif upload_type == 'user':
+            fonts_before = user_upload(request.files.getlist('fonts_before'),
+                                       jobs.staging_dir(uuid, 'before'))
+        else:
+            raise Exception(
+                'Upload type {} is not supported'.format(upload_type))
+        fonts_after = user_upload(request.files.getlist('fonts_after'),
+                                  jobs.staging_dir(uuid, 'after'))
+    with timed('db_write'):
+        jobs.enqueue(get_conn(), uuid, upload_type, fonts_before, fonts_after,
+                     previous_uuid=request.form.get('previous_uuid'))
     if from_api:
         return redirect(url_for("api_uuid_info", uuid=uuid))
     return redirect(url_for("compare", view='waterfall', uuid=uuid))
@@ -113,9 +131,12 @@ def upload_fonts(upload_type=None):
 @app.route('/compare/<uuid>', defaults={"view": "waterfall", "font_size": 60})
 def compare(uuid, view, font_size, font_position='before'):
     families = list(r.table('families')
-        .filter({'uuid': uuid}).run(g.rdb_conn))[0]
-    families_diffs = list(r.table('families_diffs')
-        .filter({'uuid': uuid, 'view': view}).run(g.rdb_conn))
+        .get_all(uuid, index='uuid').run(get_conn()))[0]
+    status = families.get('status', jobs.DONE)
+    if status == jobs.FAILED:
+        return render_template("error.html", traceback=families['error'])
+    if status != jobs.DONE:
+        return render_template("pending.html", family=families, uuid=uuid)
 
     # if user includes <url>?styles=Regular,Bold etc
     # only show Regular and Bold styles
@@ -124,8 +145,21 @@ def compare(uuid, view, font_size, font_position='before'):
     filter_styles = [s for s in filter_styles if s in families['styles']]
     if filter_styles:
         families['styles'] = [s for s in families['styles'] if s in filter_styles]
-    if filter_styles and families_diffs:
-        families_diffs = [d for d in families_diffs if d['font_before'] in filter_styles]
+
+    # Diff items are paginated with <url>?page=2&per_page=100. The
+    # glyphs_modified items are stored most severe first, see
+    # FamilyComparison.rank, so ?per_page=N shows the N worst glyphs and
+    # only their pages are read.
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = request.args.get('per_page', DIFF_LIMIT, type=int)
+    per_page = min(max(1, per_page), DIFF_LIMIT)
+    start = (page - 1) * per_page
+    with timed('db_read'):
+        families_diffs = diff_pages.fetch(get_conn(), uuid, view,
+                                          families['styles'],
+                                          start, start + per_page)
+    page_count = max([int(math.ceil(d['item_count'] / float(per_page)))
+                      for d in families_diffs] or [1])
 
     user_agent = UserAgent(request.user_agent.string)
     if families['has_vfs'] and not browser_supports_vfs(user_agent):
@@ -144,7 +178,11 @@ def compare(uuid, view, font_size, font_position='before'):
         family=families,
         font_diffs=families_diffs,
         font_position=font_position,
-        limit=DIFF_LIMIT,
+        limit=per_page,
+        page=page,
+        per_page=per_page,
+        page_count=page_count,
+        start=start,
         view=view,
         views=VIEWS,
         uuid=uuid,
@@ -156,21 +194,55 @@ def compare(uuid, view, font_size, font_position='before'):
 def api_uuid_info(uuid):
     """Return info regarding a diff"""
     families = list(r.table('families')
-                 .filter({'uuid': uuid}).run(g.rdb_conn))[0]
-    families_diffs = list(r.table('families_diffs')
-        .filter({'uuid': uuid}).run(g.rdb_conn))
-
-    changed = set({})
-    for diff in families_diffs:
-        if len(diff['items']) != 0:
-            changed.add(diff['view'])
+                 .get_all(uuid, index='uuid').run(get_conn()))[0]
+    status = families.get('status', jobs.DONE)
+    if status != jobs.DONE:
+        return json.dumps(_job_status(families))
 
-    return json.dumps({
-        'uuid': uuid,
+    info = _job_status(families)
+    info.update({
         'fonts': families['styles'],
-        'diffs': list(changed),
-        'has_vfs': families['has_vfs']
+        'diffs': diff_pages.changed_views(get_conn(), uuid),
+        'has_vfs': families['has_vfs'],
+        'media': _media_urls(uuid),
     })
+    return json.dumps(info)
+
+
+def _media_urls(uuid):
+    """Return the paths, relative to static, of an upload's media. These
+    include the diff images rendered by the job worker."""
+    media_dir = os.path.join(MEDIA_DIR, uuid)
+    if not os.path.isdir(media_dir):
+        return []
+    return [os.path.join('media', uuid, f) for f in sorted(os.listdir(media_dir))]
+
+
+@app.route("/api/status/<uuid>")
+def api_uuid_status(uuid):
+    """Return the progress of an upload's diff job"""
+    families = list(r.table('families')
+                 .get_all(uuid, index='uuid').run(get_conn()))[0]
+    return json.dumps(_job_status(families))
+
+
+def _job_status(families):
+    status = {
+        'uuid': families['uuid'],
+        'status': families.get('status', jobs.DONE),
+        'stage': families.get('stage', jobs.DONE),
+        'progress': families.get('progress', 1),
+    }
+    if status['status'] == jobs.FAILED:
+        status['error'] = families['error']
+    return status
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus metrics aggregated over the app and job processes"""
+    body, content_type = metrics.export()
+    return Response(body, content_type=content_type)
 
 
 @app.route("/api/upload-media", methods=['POST'])
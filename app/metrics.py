@@ -0,0 +1,150 @@
+"""Prometheus metrics.
+
+The app runs in several uWSGI worker processes plus the job workers, so
+the metrics are collected with prometheus_client's multiprocess mode.
+Each process writes its samples to METRICS_DIR and /metrics aggregates
+them. uwsgi.ini sets prometheus_multiproc_dir, which must be set before
+prometheus_client is imported, and empties the dir when the app is
+(re)started. Without it, e.g when the app is run by hand, each process
+only reports its own samples."""
+import os
+from settings import METRICS_DIR
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    CONTENT_TYPE_LATEST,
+)
+from gfregression import timing
+
+__all__ = ['install', 'observe_request', 'observe_job', 'observe_cache',
+           'observe_pool', 'mark_process_dead', 'export']
+
+REQUEST_SECONDS = Histogram(
+    'gfregression_request_seconds',
+    'Time taken to handle a request',
+    ['endpoint'],
+)
+
+# Diff jobs take minutes so the default buckets, which stop at 10s, are
+# too small
+STAGE_SECONDS = Histogram(
+    'gfregression_stage_seconds',
+    'Time spent in each stage of the diff pipeline',
+    ['stage'],
+    buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 120, 300, 600,
+             float('inf')),
+)
+
+JOBS = Counter(
+    'gfregression_jobs_total',
+    'Diff jobs run by the job workers',
+    ['status'],
+)
+
+CACHE_LOOKUPS = Counter(
+    'gfregression_cache_lookups_total',
+    'Lookups of the disk caches shared between uploads',
+    ['cache', 'result'],
+)
+
+# Cumulative ConnectionPool.stats() counts, exported as the increase
+# since the last request, see observe_pool
+POOL_COUNTERS = {
+    'wait_time': Counter(
+        'gfregression_db_pool_wait_seconds_total',
+        'Time spent waiting for a database connection from the pool',
+    ),
+    'exhausted': Counter(
+        'gfregression_db_pool_exhausted_total',
+        'Connections requested while every pooled connection was in use',
+    ),
+    'timeouts': Counter(
+        'gfregression_db_pool_timeouts_total',
+        'Requests which gave up waiting for a pooled connection',
+    ),
+    'reconnects': Counter(
+        'gfregression_db_pool_reconnects_total',
+        'Stale pooled connections which were reconnected',
+    ),
+}
+POOL_CONNECTIONS = Gauge(
+    'gfregression_db_pool_connections',
+    'Database connections held by the app processes\' pools',
+    ['state'],
+    multiprocess_mode='livesum',
+)
+
+# Last ConnectionPool.stats() seen by observe_pool in this process
+_pool_stats = {}
+
+
+def _observe_stage(stage, elapsed):
+    STAGE_SECONDS.labels(stage).observe(elapsed)
+
+
+_installed = False
+
+
+def install():
+    """Report the gfregression.timing stages of this process to
+    STAGE_SECONDS"""
+    global _installed
+    if not _installed:
+        timing.add_listener(_observe_stage)
+        _installed = True
+
+
+def observe_request(endpoint, elapsed):
+    REQUEST_SECONDS.labels(endpoint or 'unknown').observe(elapsed)
+
+
+def observe_job(status):
+    JOBS.labels(status).inc()
+
+
+def observe_cache(cache, hits, misses):
+    """Count a cache's hits and misses since it was last observed"""
+    if hits:
+        CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, 'miss').inc(misses)
+
+
+def observe_pool(stats):
+    """Report a ConnectionPool's stats. Called after every request."""
+    for key, counter in POOL_COUNTERS.items():
+        increase = stats[key] - _pool_stats.get(key, 0)
+        if increase < 0:
+            # The pool was replaced, e.g after uWSGI forked the process
+            increase = stats[key]
+        if increase:
+            counter.inc(increase)
+        _pool_stats[key] = stats[key]
+    POOL_CONNECTIONS.labels('open').set(stats['open'])
+    POOL_CONNECTIONS.labels('idle').set(stats['idle'])
+
+
+def mark_process_dead(pid):
+    """Remove the live gauge samples of a process which has exited, so
+    POOL_CONNECTIONS stops summing them"""
+    if 'prometheus_multiproc_dir' in os.environ:
+        multiprocess.mark_process_dead(pid, METRICS_DIR)
+
+
+def export():
+    """Return the metrics of every process in the text exposition format.
+
+    Returns
+    -------
+    (body, content_type)
+    """
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=METRICS_DIR)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
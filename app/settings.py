@@ -1,8 +1,25 @@
 import os
 
+RDB_HOST = os.environ.get('RDB_HOST') or 'localhost'
+RDB_PORT = os.environ.get('RDB_PORT') or 28015
+DB = 'diffenator_web'
+# Max connections each app process keeps open to rethinkdb
+RDB_POOL_SIZE = int(os.environ.get('GFR_RDB_POOL_SIZE', 10))
+# Seconds to wait for a free connection once the pool is exhausted
+RDB_POOL_TIMEOUT = 10
+# Seconds a pooled connection can be idle before it is health checked
+RDB_POOL_CHECK_INTERVAL = 30
+
 GLYPH_AREA_THRESHOLD = 7000
 FONTS_DIR = os.path.join('static', 'fonts')
 MEDIA_DIR = os.path.join('static', 'media')
+# Each upload's stylesheet is written here once its job has run. nginx
+# serves the directory with long lived cache headers, so file names
+# include a digest of their css.
+STYLESHEETS_DIR = os.path.join('static', 'stylesheets')
+# Uploaded fonts are staged here until their job has finished. The dir is
+# inside FONTS_DIR so staged fonts are kept on the same volume.
+UPLOADS_DIR = os.path.join(FONTS_DIR, 'uploads')
 
 
 if 'GFR_DO_NOT_DIFF_FAMILIES' in os.environ:
@@ -10,6 +27,13 @@ if 'GFR_DO_NOT_DIFF_FAMILIES' in os.environ:
 else:
     DIFF_FAMILIES = True
 
+# Rasterise the before and after glyphs and text samples on the server and
+# save their diff images in MEDIA_DIR/<uuid>, see gfregression.raster
+if 'GFR_DO_NOT_RENDER_DIFFS' in os.environ:
+    RENDER_DIFFS = False
+else:
+    RENDER_DIFFS = True
+
 if DIFF_FAMILIES:
     VIEWS = [
         'glyphs_all', 'text', 'glyphs_new', 'glyphs_missing', 'glyphs_modified',
@@ -20,8 +44,37 @@ if DIFF_FAMILIES:
     ]
 else:
     VIEWS = ['glyphs_all', 'text']
+if RENDER_DIFFS:
+    VIEWS.append('glyphs_pixels')
 
 DIFF_LIMIT = 800
+# Diff items are stored in pages of this many items, see diff_pages.py
+DIFF_PAGE_SIZE = 200
+# Store diff items as columns rather than one dict per item, which
+# doesn't repeat the item keys in every item
+if 'GFR_DIFF_COLUMNAR' in os.environ:
+    DIFF_COLUMNAR = True
+else:
+    DIFF_COLUMNAR = False
+
+# Number of processes used by diff_families to diff styles in parallel
+DIFF_WORKERS = int(os.environ.get('GFR_DIFF_WORKERS', 1))
+# VF against VF uploads are also diffed at this many locations along each
+# shared axis, as well as at each named instance. 0 disables the grid.
+VF_GRID_STEPS = int(os.environ.get('GFR_VF_GRID_STEPS', 0))
+
+# Number of worker processes which pull upload jobs from the jobs table
+JOB_WORKERS = int(os.environ.get('GFR_JOB_WORKERS', 2))
+# Seconds a job worker sleeps when the queue is empty
+JOB_POLL_INTERVAL = 1
+
+# Style diffs are cached by the hashes of the fonts which were diffed, so
+# uploads of unchanged fonts reuse the previous results
+DIFF_CACHE_DIR = os.path.join('cache', 'diffs')
+DIFF_CACHE_SIZE = int(os.environ.get('GFR_DIFF_CACHE_SIZE', 2 * 1024 ** 3))
+
+# Each process writes its prometheus samples here, see metrics.py
+METRICS_DIR = os.environ.get('prometheus_multiproc_dir') or 'metrics'
 
 
 if "GFR_PRODUCTION_MODE" in os.environ:
@@ -0,0 +1,52 @@
+"""Run the upload job workers.
+
+The workers are started by uWSGI, see uwsgi.ini. They can also be run
+by hand:
+
+    python worker.py
+"""
+from __future__ import print_function
+import time
+from multiprocessing import Process
+import rethinkdb as r
+
+import init_db
+import jobs
+import metrics
+from settings import (
+    RDB_HOST,
+    RDB_PORT,
+    DB,
+    JOB_WORKERS,
+    JOB_POLL_INTERVAL,
+)
+
+
+def work():
+    """Pull jobs from the queue until the process is stopped"""
+    metrics.install()
+    conn = r.connect(host=RDB_HOST, port=RDB_PORT, db=DB)
+    while True:
+        job = jobs.claim(conn)
+        if not job:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        print('Running job %s' % job['id'])
+        jobs.run(conn, job)
+
+
+def main():
+    init_db.build_tables(host=RDB_HOST, port=RDB_PORT, db=DB)
+    conn = r.connect(host=RDB_HOST, port=RDB_PORT, db=DB)
+    jobs.requeue_stale(conn)
+    conn.close()
+
+    workers = [Process(target=work) for _ in range(JOB_WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Compare the original _diff_serialiser, which mutated the diffs in
+place, against gfregression.serialise.
+
+Usage:
+
+    python benchmarks/serialise.py font_before.ttf font_after.ttf
+
+The glyphs_all dump of font_before and the diffs of the two fonts are
+serialised with both implementations. The time taken to encode a
+rethinkdb insert of the results is then compared when the diffs are
+passed as python objects, which the driver converts into a term for
+every value, and when they are passed as a json string made by
+gfregression.serialise.dumps, which uses orjson if it is installed.
+"""
+from __future__ import print_function
+import sys
+import timeit
+import rethinkdb as r
+from rethinkdb.ast import ReQLEncoder
+from diffenator.font import DFont
+from diffenator.diff import DiffFonts
+from diffenator.dump import dump_glyphs
+from gfregression import DIFF_CATEGORIES
+from gfregression.serialise import serialise_diff, dumps
+
+REPEAT = 5
+
+
+def legacy_diff_serialiser(d):
+    """_diff_serialiser before gfregression.serialise was added"""
+    for k in d:
+        if isinstance(d[k], dict):
+            legacy_diff_serialiser(d[k])
+        if isinstance(d[k], list):
+            for idx, item in enumerate(d[k]):
+                legacy_diff_serialiser(item)
+        if hasattr(d[k], 'font'):
+            d[k].font = None
+        if hasattr(d[k], 'key'):
+            d[k] = dict(d[k].__dict__)
+    return d
+
+
+def glyphs_all(font_before, font_after):
+    return [{'view': 'glyphs_all', 'items': dump_glyphs(font_before)._data}]
+
+
+def style_diffs(font_before, font_after):
+    diff = DiffFonts(font_before, font_after,
+                     settings=dict(to_diff=DIFF_CATEGORIES))
+    return [{'view': '{}_{}'.format(cat, subcat),
+             'items': diff._data[cat][subcat]._data}
+            for cat in diff._data for subcat in diff._data[cat]]
+
+
+def encode_insert(docs):
+    """Encode an insert query the way the driver does before sending it"""
+    return ReQLEncoder().encode(r.table('families_diffs').insert(docs))
+
+
+def best_time(func, make_diffs):
+    """Time func on fresh diffs. The legacy serialiser destroys its input
+    so the diffs are rebuilt, untimed, before each run."""
+    times = []
+    for _ in range(REPEAT):
+        diffs = make_diffs()
+        start = timeit.default_timer()
+        func(diffs)
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def main(args=None):
+    paths = sys.argv[1:] if args is None else args
+    if len(paths) != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    print('%-12s %6s %10s %10s %8s' % (
+        'diffs', 'items', 'legacy', 'new', 'speedup'))
+    for name, build in (('glyphs_all', glyphs_all), ('style diffs', style_diffs)):
+        def make_diffs():
+            return build(DFont(paths[0]), DFont(paths[1]))
+
+        diffs = make_diffs()
+        legacy_result = [legacy_diff_serialiser(d) for d in make_diffs()]
+        new_result = [serialise_diff(d) for d in diffs]
+        for legacy_diff, new_diff in zip(legacy_result, new_result):
+            for legacy_item, new_item in zip(legacy_diff['items'],
+                                             new_diff['items']):
+                for value in legacy_item.values():
+                    if isinstance(value, dict):
+                        value.pop('font', None)
+                if legacy_item != new_item:
+                    raise Exception('Results differ for %s' % name)
+
+        item_count = sum(len(d['items']) for d in diffs)
+        legacy = best_time(
+            lambda ds: [legacy_diff_serialiser(d) for d in ds], make_diffs)
+        new = best_time(lambda ds: [serialise_diff(d) for d in ds],
+                        make_diffs)
+        print('%-12s %6s %9.4fs %9.4fs %7.1fx' % (
+            name, item_count, legacy, new, legacy / new))
+
+        objects_time = min(timeit.repeat(
+            lambda: encode_insert(new_result), number=1, repeat=REPEAT))
+        json_time = min(timeit.repeat(
+            lambda: encode_insert(r.json(dumps(new_result).decode('utf-8'))),
+            number=1, repeat=REPEAT))
+        print('%-12s %6s %9.4fs %9.4fs %7.1fx  (insert encoding)' % (
+            '', '', objects_time, json_time, objects_time / json_time))
+
+
+if __name__ == '__main__':
+    main()
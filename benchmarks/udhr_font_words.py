@@ -0,0 +1,71 @@
+"""Compare the original udhr_font_words, which scanned the whole UDHR
+corpus on every call, against the precomputed UDHRIndex.
+
+Usage:
+
+    python benchmarks/udhr_font_words.py [font.ttf ...]
+
+If no fonts are given, Latin, Cyrillic and CJK cmaps are synthesised from
+their unicode blocks.
+"""
+from __future__ import print_function
+import sys
+import timeit
+from fontTools.ttLib import TTFont
+from gfregression.udhr import UDHR_PATH, UDHRIndex
+
+LATIN = set(range(0x20, 0x7F)) | set(range(0xA0, 0x180))
+CMAPS = {
+    'latin': LATIN,
+    'cyrillic': LATIN | set(range(0x400, 0x530)),
+    'cjk': LATIN | set(range(0x3000, 0x3100)) | set(range(0x4E00, 0xA000)),
+}
+
+
+def legacy_udhr_font_words(cmap):
+    """udhr_font_words before the index was added"""
+    with open(UDHR_PATH, "r") as doc:
+        text = doc.read()
+
+    cmap = set(cmap)
+    words = []
+    seen_chars = set()
+    for word in text.split():
+        chars = set(ord(l) for l in word)
+        if not chars.issubset(cmap):
+            continue
+        if chars & seen_chars == chars:
+            continue
+        seen_chars |= chars
+        words.append(word)
+    return words
+
+
+def main(args=None):
+    paths = sys.argv[1:] if args is None else args
+    if paths:
+        cmaps = {p: set(TTFont(p).getBestCmap()) for p in paths}
+    else:
+        cmaps = CMAPS
+
+    with open(UDHR_PATH, "r") as doc:
+        text = doc.read()
+    start = timeit.default_timer()
+    index = UDHRIndex(text)
+    print('Index built in %.3fs (%s unique words)' % (
+        timeit.default_timer() - start, len(index.words)))
+
+    print('%-12s %10s %10s %8s' % ('cmap', 'legacy', 'index', 'speedup'))
+    for name, cmap in sorted(cmaps.items()):
+        if legacy_udhr_font_words(cmap) != index.font_words(cmap):
+            raise Exception('Results differ for %s' % name)
+        legacy = min(timeit.repeat(lambda: legacy_udhr_font_words(cmap),
+                                   number=1, repeat=5))
+        indexed = min(timeit.repeat(lambda: index.font_words(cmap),
+                                    number=1, repeat=5))
+        print('%-12s %9.4fs %9.4fs %7.1fx' % (name, legacy, indexed,
+                                            legacy / indexed))
+
+
+if __name__ == '__main__':
+    main()
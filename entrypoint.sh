@@ -52,6 +52,12 @@ else
     content_server=$content_server"    location $USE_STATIC_URL {\n"
     content_server=$content_server"        alias $USE_STATIC_PATH;\n"
     content_server=$content_server'    }\n'
+    # Upload stylesheets never change, their file names include a digest
+    content_server=$content_server"    location $USE_STATIC_URL/stylesheets/ {\n"
+    content_server=$content_server"        alias $USE_STATIC_PATH/stylesheets/;\n"
+    content_server=$content_server'        etag on;\n'
+    content_server=$content_server'        add_header Cache-Control "public, max-age=31536000, immutable";\n'
+    content_server=$content_server'    }\n'
     # If STATIC_INDEX is 1, serve / with /static/index.html directly (or the static URL configured)
     if [ "$STATIC_INDEX" = 1 ] ; then
         content_server=$content_server'    location = / {\n'
@@ -18,12 +18,24 @@ setup(
     entry_points={
         "console_scripts": [
             "find-camelcase-families = gfregression.gf_families_ignore_camelcase:main",
+            "gfregression-benchmark = gfregression.benchmark:main",
         ],
     },
     install_requires=[
         "fontdiffenator",
         "flask",
+        # fontTools.varLib.instancer, see gfregression.variations
+        "fonttools>=4.0.0",
+        "numpy",
+        "freetype-py",
+        # ImageFont.FreeTypeFont.getlength, see gfregression.raster
+        "Pillow>=8.0",
+        "prometheus_client",
         "requests",
         "rethinkdb==2.3.0.post6",
     ],
+    extras_require={
+        # Faster encoding of diffs, see gfregression.serialise
+        "fast": ["orjson", "msgpack"],
+    },
 )
@@ -0,0 +1,95 @@
+from gfregression import downloadfonts
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import threading
+import tempfile
+import time
+import os
+import unittest
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FontsHandler(BaseHTTPRequestHandler):
+    """Serve /<name> as the bytes of name. Paths starting with /flaky fail
+    with a 503 on their first request."""
+    lock = threading.Lock()
+    requested = set()
+    active = 0
+    max_active = 0
+
+    def do_GET(self):
+        cls = FontsHandler
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            first_request = self.path not in cls.requested
+            cls.requested.add(self.path)
+        try:
+            time.sleep(0.05)
+            if self.path.startswith('/flaky') and first_request:
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = self.path[1:].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadFiles(unittest.TestCase):
+
+    def setUp(self):
+        FontsHandler.requested = set()
+        FontsHandler.max_active = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FontsHandler)
+        self.base_url = 'http://127.0.0.1:%s' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.dst = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dst.cleanup()
+
+    def test_download_files(self):
+        names = ['Font-%s.ttf' % i for i in range(12)]
+        downloads = [('%s/%s' % (self.base_url, n), os.path.join(self.dst.name, n))
+                     for n in names]
+        downloadfonts.download_files(downloads)
+        for name in names:
+            with open(os.path.join(self.dst.name, name)) as doc:
+                self.assertEqual(name, doc.read())
+
+    def test_download_files_host_limit(self):
+        downloads = [('%s/Font-%s.ttf' % (self.base_url, i),
+                      os.path.join(self.dst.name, 'Font-%s.ttf' % i))
+                     for i in range(12)]
+        downloadfonts.download_files(downloads, workers=12)
+        self.assertLessEqual(FontsHandler.max_active,
+                             downloadfonts.DOWNLOAD_HOST_LIMIT)
+
+    def test_download_file_retries(self):
+        dst = os.path.join(self.dst.name, 'flaky.ttf')
+        downloadfonts.download_file(self.base_url + '/flaky.ttf', dst)
+        with open(dst) as doc:
+            self.assertEqual('flaky.ttf', doc.read())
+
+    def test_download_file_to_tempfile(self):
+        with downloadfonts.download_file(self.base_url + '/Font.ttf') as doc:
+            self.assertEqual(b'Font.ttf', doc.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
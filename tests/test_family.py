@@ -4,17 +4,36 @@ from gfregression import (
     FontStyle,
     family_from_googlefonts,
     family_from_github_dir,
+    family_from_paths,
     familyname_from_filename,
     get_families,
+    families_stylesheet,
     diff_families,
     families_glyphs_all,
+    families_glyph_hashes,
+    FamilyComparison,
 
 )
+from gfregression.cache import DiffCache, diff_cache_key
+from gfregression.udhr import UDHRIndex
+from gfregression.serialise import serialise_diff, dumps, loads
+from gfregression import vectorised
+from gfregression.variations import grid_locations, InstanceCache
+from gfregression import raster
+from gfregression.incremental import INCREMENTAL_VIEWS, changed_keys
+from diffenator.dump import dump_glyphs
+from diffenator.font import DFont
+from fontTools.ttLib import TTFont
+from diffenator.diff import diff_glyphs, diff_metrics
 import tempfile
 import os
+import json
+import time
 import shutil
 import unittest
+from unittest import mock
 from glob import glob
+from zipfile import ZipFile
 
 
 class TestFamily(unittest.TestCase):
@@ -31,6 +50,17 @@ class TestFamily(unittest.TestCase):
             family.append(path)
         self.assertEqual(family.name, 'Roboto')
 
+    def test_family_from_paths_copy(self):
+        with tempfile.TemporaryDirectory() as staging_dir, \
+                tempfile.TemporaryDirectory() as dst:
+            staged = [shutil.copy(p, staging_dir) for p in self.roboto_fonts]
+            for _ in range(2):
+                family = family_from_paths(staged, dst, copy=True)
+                self.assertEqual(len(staged), len(family.fonts))
+            self.assertTrue(all(os.path.isfile(p) for p in staged))
+            family_from_paths(staged, dst)
+            self.assertFalse(any(os.path.isfile(p) for p in staged))
+
     # def test_append_font_which_does_not_belong_to_family(self):
     #     family = Family()
     #     family.append(self.path_1)
@@ -65,6 +95,11 @@ class TestFont(unittest.TestCase):
         self.assertIn("CondensedRegular", styles)
         self.assertIn("Regular", styles)
 
+    def test_dfont_built_on_first_access(self):
+        self.assertIn("font-family", self.vf_font.css_font_face)
+        self.assertIsNone(self.vf_font._font)
+        self.assertEqual(True, self.vf_font.font.is_variable)
+
  
  
 class TestFontStyle(unittest.TestCase):
@@ -153,6 +188,22 @@ class TestGetFamilies(unittest.TestCase):
         family_match = get_families(family_before, family_after, uuid)
         self.assertEqual(sorted(["Regular", "Bold"]), sorted(family_match["styles"]))
 
+    def test_families_stylesheet(self):
+        family_before = Family()
+        family_after = Family()
+        for path in self.roboto_fonts:
+            family_before.append(path)
+            family_after.append(path)
+
+        families = get_families(family_before, family_after, "1234")
+        stylesheet = families_stylesheet(families)
+        self.assertEqual(len(self.roboto_fonts) * 2,
+                         stylesheet.count('@font-face'))
+        for style in families['styles']:
+            self.assertIn('.%s{' % style, stylesheet)
+        self.assertIn('font-family: %s;' % families['after']['name'],
+                      stylesheet)
+
     def test_familyname_from_filename(self):
         filename = "Kreon[wght].ttf"
         self.assertEqual("Kreon", familyname_from_filename(filename))
@@ -191,12 +242,388 @@ class TestDiffFamilies(unittest.TestCase):
         diff = diff_families(self.family_before, self.family_after, uuid)
         self.assertNotEqual(0, len(diff))
 
+    def test_diff_families_parallel(self):
+        uuid = '1234'
+        diff = diff_families(self.family_before, self.family_after, uuid)
+        diff_parallel = diff_families(self.family_before, self.family_after,
+                                      uuid, workers=2)
+        self.assertEqual(
+            [(d['view'], d['font_before']) for d in diff],
+            [(d['view'], d['font_before']) for d in diff_parallel]
+        )
+
+    def test_diff_families_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiffCache(cache_dir, 1024 ** 3)
+            diff = diff_families(self.family_before, self.family_after, '1234',
+                                 cache=cache)
+            self.assertEqual(0, cache.hits)
+            cached_diff = diff_families(self.family_before, self.family_after,
+                                        '5678', cache=cache)
+            self.assertEqual(cache.misses, cache.hits)
+            self.assertEqual(len(diff), len(cached_diff))
+            self.assertEqual(set(['5678']), set(d['uuid'] for d in cached_diff))
+
+    def test_family_comparison_run(self):
+        stages = []
+        with FamilyComparison(self.family_before, self.family_after,
+                              '1234') as comparison, \
+                tempfile.TemporaryDirectory() as media_dir:
+            diff, glyph_hashes, families = comparison.run(
+                media_dir=media_dir,
+                on_stage=lambda stage, amount: stages.append(stage))
+            # Static families are never instanced
+            self.assertIsNone(comparison._instances)
+            self.assertEqual(
+                ['diffing families', 'ranking glyphs', 'dumping glyphs',
+                 'rendering'], stages)
+            self.assertEqual(
+                set(['glyphs_all', 'text', 'glyphs_pixels']),
+                set(d['view'] for d in diff) &
+                set(['glyphs_all', 'text', 'glyphs_pixels'])
+            )
+            self.assertIn('Regular-waterfall.png', os.listdir(media_dir))
+        self.assertEqual(len(comparison.shared_styles), len(glyph_hashes))
+        self.assertEqual(comparison.shared_styles, families['styles'])
+
+    def test_diff_families_incremental(self):
+        current_dir = os.path.dirname(__file__)
+        roboto_fonts_dir = os.path.join(current_dir, "data", "Roboto")
+        regular = os.path.join(roboto_fonts_dir, "Roboto-Regular.ttf")
+        bold = os.path.join(roboto_fonts_dir, "Roboto-Bold.ttf")
+
+        # diffenator modifies a DFont's kerns when it diffs them, so each
+        # diff gets new families
+        def families(path_after):
+            family_before = Family()
+            family_before.append(regular)
+            family_after = Family()
+            family_after.append(path_after, 'Roboto', 'Regular')
+            return family_before, family_after
+
+        previous_diff = diff_families(*families(bold), uuid='1234')
+        previous = {
+            h['style']: dict(h, diffs={}) for h in
+            families_glyph_hashes(*families(bold), uuid='1234')
+        }
+        for d in previous_diff:
+            if d['view'] in INCREMENTAL_VIEWS:
+                previous[d['font_before']]['diffs'][d['view']] = d['items']
+
+        with tempfile.TemporaryDirectory() as modified_dir:
+            # Bold with one glyph's outline scaled and one advance changed
+            ttfont = TTFont(bold)
+            glyf = ttfont['glyf']
+            glyf['A'].coordinates.scale((1.2, 1.2))
+            glyf['A'].recalcBounds(glyf)
+            advance, lsb = ttfont['hmtx']['B']
+            ttfont['hmtx']['B'] = (advance + 100, lsb)
+            modified_path = os.path.join(modified_dir, "Roboto-Bold.ttf")
+            ttfont.save(modified_path)
+
+            diff = diff_families(*families(modified_path), uuid='5678')
+            incremental_diff = diff_families(*families(modified_path),
+                                             uuid='5678', previous=previous)
+
+        def items(diffs, view):
+            return set(json.dumps(i, sort_keys=True) for d in diffs
+                       if d['view'] == view for i in d['items'])
+        for view in ('glyphs_modified', 'metrics_modified'):
+            self.assertNotEqual(items(previous_diff, view), items(diff, view))
+            self.assertEqual(items(diff, view), items(incremental_diff, view))
+
+    def test_changed_keys(self):
+        self.assertEqual(
+            set(['b', 'c', 'd']),
+            changed_keys({'a': '1', 'b': '2', 'c': '3'},
+                         {'a': '1', 'b': '0', 'd': '4'})
+        )
+
     def test_families_glyphs_all(self):
         uuid = '1234'
         diff = families_glyphs_all(self.family_before, self.family_after, uuid)
         self.assertNotEqual(0, len(diff))
 
 
+class TestRank(unittest.TestCase):
+
+    def setUp(self):
+        current_dir = os.path.dirname(__file__)
+        roboto_fonts_dir = os.path.join(current_dir, "data", "Roboto")
+        self.family_before = Family()
+        self.family_before.append(
+            os.path.join(roboto_fonts_dir, "Roboto-Regular.ttf"))
+        self.family_after = Family()
+        self.family_after.append(
+            os.path.join(roboto_fonts_dir, "Roboto-Bold.ttf"), 'Roboto',
+            'Regular')
+
+    def test_rank_glyphs_modified(self):
+        with FamilyComparison(self.family_before, self.family_after,
+                              '1234') as comparison:
+            diff = comparison.diff_families()
+            comparison.rank(diff)
+        modified = [d for d in diff if d['view'] == 'glyphs_modified'][0]
+        severities = [i['severity'] for i in modified['items']]
+        self.assertNotEqual(0, len(severities))
+        self.assertEqual(sorted(severities, reverse=True), severities)
+        for item in modified['items']:
+            self.assertGreaterEqual(item['severity'], item['pixel_diff'])
+            self.assertGreaterEqual(item['severity'], abs(item['diff']))
+
+    def test_rank_without_pixels(self):
+        with FamilyComparison(self.family_before, self.family_after,
+                              '1234') as comparison:
+            diff = comparison.diff_families()
+            comparison.rank(diff, pixels=False)
+            self.assertEqual({}, comparison._rasterisers)
+        modified = [d for d in diff if d['view'] == 'glyphs_modified'][0]
+        self.assertNotEqual(0, len(modified['items']))
+        for item in modified['items']:
+            self.assertNotIn('pixel_diff', item)
+            self.assertEqual(abs(item['diff']), item['severity'])
+
+
+class TestDiffVFs(unittest.TestCase):
+
+    def setUp(self):
+        current_dir = os.path.dirname(__file__)
+        vf_path = os.path.join(current_dir, "data", "Cabin", "Cabin-VF.ttf")
+        self.family_before = Family()
+        self.family_before.append(vf_path)
+        self.family_after = Family()
+        self.family_after.append(vf_path)
+
+    def test_diff_named_instances(self):
+        diff = diff_families(self.family_before, self.family_after, '1234')
+        self.assertEqual(
+            set(s.name for s in self.family_before.fonts[0].styles),
+            set(d['font_before'] for d in diff)
+        )
+
+    def test_grid_styles(self):
+        with FamilyComparison(self.family_before, self.family_after,
+                              '1234', vf_grid=3) as comparison:
+            self.assertIn('wdth87_5-wght550', comparison.shared_styles)
+            self.assertEqual(
+                {'wdth': 87.5, 'wght': 550},
+                comparison.styles_after['wdth87_5-wght550'].coordinates
+            )
+
+    def test_grid_locations(self):
+        axes = self.family_before.fonts[0].axes
+        self.assertEqual([], grid_locations(axes, axes, 0))
+        self.assertEqual(9, len(grid_locations(axes, axes, 3)))
+
+
+class TestInstanceCache(unittest.TestCase):
+
+    def setUp(self):
+        current_dir = os.path.dirname(__file__)
+        self.vf_path = os.path.join(current_dir, "data", "Cabin", "Cabin-VF.ttf")
+
+    def test_instance_made_once(self):
+        with tempfile.TemporaryDirectory() as instances_dir:
+            instances = InstanceCache(instances_dir)
+            font = instances.font(self.vf_path, {'wght': 700})
+            self.assertFalse(font.is_variable)
+            self.assertIs(font, instances.font(self.vf_path, {'wght': 700}))
+            # A new process reuses the instance file
+            other = InstanceCache(instances_dir)
+            self.assertEqual(instances.path(self.vf_path, {'wght': 700}),
+                             other.path(self.vf_path, {'wght': 700}))
+            self.assertEqual(1, len(os.listdir(instances_dir)))
+
+    def test_evict_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as instances_dir:
+            instances = InstanceCache(instances_dir, max_size=1)
+            font = instances.font(self.vf_path, {'wght': 400})
+            instances.font(self.vf_path, {'wght': 700})
+            self.assertIsNot(font, instances.font(self.vf_path, {'wght': 400}))
+            self.assertEqual(2, len(os.listdir(instances_dir)))
+
+
+class TestRaster(unittest.TestCase):
+
+    def setUp(self):
+        current_dir = os.path.dirname(__file__)
+        roboto_fonts_dir = os.path.join(current_dir, "data", "Roboto")
+        self.regular = raster.GlyphRasteriser(
+            os.path.join(roboto_fonts_dir, "Roboto-Regular.ttf"))
+        self.bold = raster.GlyphRasteriser(
+            os.path.join(roboto_fonts_dir, "Roboto-Bold.ttf"))
+
+    def test_pixel_scores(self):
+        names = ['a', 'b', 'space']
+        scores = raster.diff_glyph_pixels(self.regular, self.bold, names,
+                                          names, batch_size=2)
+        self.assertGreater(scores[0], 0)
+        self.assertGreater(scores[1], 0)
+        self.assertEqual(0, scores[2])
+        same = raster.diff_glyph_pixels(self.regular, self.regular, names,
+                                        names)
+        self.assertEqual([0, 0, 0], list(same))
+
+    def test_diff_image(self):
+        before, after = self.regular.render(['o']), self.bold.render(['o'])
+        image, score = raster.diff_image(before[0], after[0])
+        self.assertEqual(before.shape[1:], (image.size[1], image.size[0]))
+        self.assertGreater(score, 0)
+
+
+class TestSerialise(unittest.TestCase):
+
+    def setUp(self):
+        current_dir = os.path.dirname(__file__)
+        path = os.path.join(current_dir, "data", "Roboto", "Roboto-Regular.ttf")
+        self.font = Font(path)
+
+    def test_serialise_diff_keeps_glyphs(self):
+        items = dump_glyphs(self.font.font)._data
+        diff = serialise_diff({'view': 'glyphs_all', 'items': items})
+        self.assertEqual(items[0]['glyph'].name, diff['items'][0]['glyph']['name'])
+        self.assertIsNotNone(items[0]['glyph'].font)
+        self.assertEqual(json.loads(json.dumps(diff)), loads(dumps(diff)))
+
+
+class TestVectorised(unittest.TestCase):
+
+    def setUp(self):
+        current_dir = os.path.dirname(__file__)
+        roboto_fonts_dir = os.path.join(current_dir, "data", "Roboto")
+        self.font_before = DFont(os.path.join(roboto_fonts_dir, "Roboto-Regular.ttf"))
+        self.font_after = DFont(os.path.join(roboto_fonts_dir, "Roboto-Bold.ttf"))
+        self.arrays_before = vectorised.GlyphArrays(self.font_before)
+        self.arrays_after = vectorised.GlyphArrays(self.font_after)
+
+    def test_diff_glyphs_matches_diffenator(self):
+        diff = vectorised.diff_glyphs(self.arrays_before, self.arrays_after)
+        expected = diff_glyphs(self.font_before, self.font_after)
+        for subcat in ('new', 'missing', 'modified'):
+            self.assertEqual(
+                sorted(r['glyph'].key for r in diff[subcat]._data),
+                sorted(r['glyph'].key for r in expected[subcat]._data)
+            )
+
+    def test_diff_metrics_matches_diffenator(self):
+        diff = vectorised.diff_metrics(self.arrays_before, self.arrays_after)
+        expected = diff_metrics(self.font_before, self.font_after, thresh=0)
+        self.assertEqual(
+            sorted(r['glyph'].key for r in diff['modified']._data),
+            sorted(r['glyph'].key for r in expected['modified']._data)
+        )
+
+
+class TestDiffCache(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiffCache(cache_dir, 100)
+            cache.set('a', ['x' * 40])
+            cache.set('b', ['x' * 40])
+            os.utime(cache.path('a'), (0, 0))
+            cache.set('c', ['x' * 40])
+            self.assertNotIn('a', cache)
+            self.assertIn('b', cache)
+            self.assertIn('c', cache)
+
+    def test_get_entry_evicted_after_read(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiffCache(cache_dir, 100)
+            cache.set('a', ['x'])
+
+            def evict(key):
+                os.remove(cache.path(key))
+                os.utime(cache.path(key))
+            cache.touch = evict
+            self.assertEqual(['x'], cache.get('a'))
+
+    def test_key_covers_version_and_locations(self):
+        current_dir = os.path.dirname(__file__)
+        font = Font(os.path.join(current_dir, 'data', 'Roboto',
+                                 'Roboto-Regular.ttf'))
+        key = diff_cache_key(font, font, 'Regular', 'Regular', ['glyphs'],
+                             '0.9.0', 1)
+        self.assertNotEqual(key, diff_cache_key(
+            font, font, 'Regular', 'Regular', ['glyphs'], '0.9.0', 2))
+        self.assertNotEqual(key, diff_cache_key(
+            font, font, 'Regular', 'Regular', ['glyphs'], '0.9.0', 1,
+            ({'wght': 400}, None)))
+        self.assertEqual(
+            diff_cache_key(font, font, 'Regular', 'Regular', ['glyphs'],
+                           '0.9.0', 1, ({'wght': 400, 'wdth': 100}, None)),
+            diff_cache_key(font, font, 'Regular', 'Regular', ['glyphs'],
+                           '0.9.0', 1, ({'wdth': 100, 'wght': 400}, None)))
+
+
+class TestUDHRIndex(unittest.TestCase):
+
+    def test_font_words(self):
+        index = UDHRIndex("abc cab xyz ab bcd d")
+        cmap = [ord(c) for c in "abcdxy"]
+        self.assertEqual(["abc", "bcd"], index.font_words(cmap))
+
+
+class TestGoogleFontsAPICache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        families = ["Cabin", "Cabin Condensed", "Cabin Sketch", "Roboto"]
+        with open(os.path.join(self.cache_dir, "webfonts.json"), "w") as doc:
+            json.dump({
+                "fetched": time.time(),
+                "etag": None,
+                "last_modified": None,
+                "data": {"items": [{"family": f} for f in families]},
+            }, doc)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached_api_data(self):
+        from gfregression.downloadfonts import GoogleFonts
+        googlefonts = GoogleFonts("no-key", cache_dir=self.cache_dir)
+        self.assertEqual(True, googlefonts.has_family("Cabin Sketch"))
+        self.assertEqual(False, googlefonts.has_family("Cabin Sketc"))
+        self.assertEqual(["Cabin", "Cabin Condensed"],
+                         googlefonts.width_families("Cabin"))
+
+    def _download_zip(self, url):
+        """Stands in for downloadfonts.download_file"""
+        zip_file = tempfile.TemporaryFile()
+        with ZipFile(zip_file, 'w') as fonts_zip:
+            fonts_zip.writestr('Cabin-Regular.ttf', b'font')
+        zip_file.seek(0)
+        return zip_file
+
+    def test_failed_download_is_not_cached(self):
+        from gfregression import downloadfonts
+        googlefonts = downloadfonts.GoogleFonts("no-key",
+                                                cache_dir=self.cache_dir)
+
+        def download_file(url):
+            raise Exception("Connection failed")
+        with mock.patch.object(downloadfonts, 'download_file', download_file):
+            with self.assertRaises(Exception):
+                googlefonts.download_family("Cabin", self.cache_dir)
+        self.assertEqual([], os.listdir(googlefonts.family_cache.root))
+
+    def test_download_family_larger_than_cache(self):
+        from gfregression import downloadfonts
+        googlefonts = downloadfonts.GoogleFonts("no-key",
+                                                cache_dir=self.cache_dir)
+        googlefonts.family_cache.max_size = 0
+        dst = os.path.join(self.cache_dir, 'fonts')
+        with mock.patch.object(downloadfonts, 'download_file',
+                               self._download_zip):
+            for _ in range(2):
+                fonts = googlefonts.download_family("Cabin", dst)
+                self.assertEqual([os.path.join(dst, 'Cabin-Regular.ttf')],
+                                 fonts)
+                self.assertTrue(os.path.isfile(fonts[0]))
+        self.assertEqual(2, googlefonts.family_cache.misses)
+
+
 class TestGoogleFontsAPI(unittest.TestCase):
 
     def setUp(self):
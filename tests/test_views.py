@@ -1,11 +1,19 @@
 import os
+import hashlib
+import tempfile
 import unittest
+from unittest import mock
 import requests
 from werkzeug.useragents import UserAgent
 import sys
 cwd = os.path.dirname(__file__)
 sys.path.append(os.path.join(cwd, "..", "app"))
 from utils import browser_supports_vfs, secret
+from rethinkdb.errors import ReqlDriverError
+from gfregression.serialise import dumps, loads
+import diff_pages
+import db
+import jobs
 
 
 class TestApiEndPoints(unittest.TestCase):
@@ -55,6 +63,14 @@ class TestApiEndPoints(unittest.TestCase):
                                 headers={"Access-Token": secret("ACCESS_TOKEN")})
         self.assertEqual(request.status_code, 200)
 
+    def test_metrics(self):
+        """Test request timings are exported on the /metrics endpoint"""
+        requests.get(self.local_base_url + '/')
+        request = requests.get(self.local_base_url + '/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertIn('gfregression_request_seconds_count{endpoint="index"}',
+                      request.text)
+
 
 class TestNonVFBrowser(unittest.TestCase):
 
@@ -70,5 +86,133 @@ class TestNonVFBrowser(unittest.TestCase):
         self.assertEqual(browser_supports_vfs(user_agent), False)
 
 
+class TestDiffPages(unittest.TestCase):
+
+    def setUp(self):
+        self.diff = {
+            'uuid': '1234',
+            'view': 'glyphs_all',
+            'font_before': 'Regular',
+            'font_after': 'Regular',
+            'items': list(range(450)),
+        }
+
+    def test_paginate(self):
+        pages = diff_pages.paginate([self.diff], page_size=200)
+        self.assertEqual([p['page'] for p in pages], [0, 1, 2])
+        self.assertEqual([len(p['items']) for p in pages], [200, 200, 50])
+        self.assertEqual(set(p['item_count'] for p in pages), set([450]))
+
+    def test_paginate_diff_without_items(self):
+        text = {'uuid': '1234', 'view': 'text', 'font_before': 'Regular',
+                'font_after': 'Regular', 'text': 'abc'}
+        pages = diff_pages.paginate([text], page_size=200)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0]['text'], 'abc')
+
+    def test_merge_pages(self):
+        pages = diff_pages.paginate([self.diff], page_size=200)
+        diffs = diff_pages._merge(reversed(pages[:2]), ['Regular'])
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(diffs[0]['items'], list(range(400)))
+        self.assertEqual(diffs[0]['item_count'], 450)
+        self.assertNotIn('page', diffs[0])
+
+    def test_columnar_pages(self):
+        items = [{'glyph': {'name': 'g%s' % i, 'characters': 'a'}, 'area': i}
+                 for i in range(450)]
+        diff = dict(self.diff, items=items)
+        pages = diff_pages.paginate([diff], page_size=200, columnar=True)
+        self.assertNotIn('items', pages[0])
+        self.assertEqual(len(pages[2]['columns'][0]), 50)
+        diffs = diff_pages._merge(pages, ['Regular'])
+        self.assertEqual(len(diffs[0]['items']), 450)
+        self.assertEqual(list(diffs[0]['items'][:3]), items[:3])
+        self.assertEqual(diffs[0]['items'][449], items[449])
+
+    def test_pixel_diff_pages_keep_images(self):
+        images = {'glyphs': 'Regular-glyphs.png',
+                  'waterfall': 'Regular-waterfall.png'}
+        items = [{'glyph': {'name': 'g%s' % i}, 'pixel_diff': 0.5}
+                 for i in range(450)]
+        diff = dict(self.diff, view='glyphs_pixels', items=items,
+                    images=images, sample_scores={'waterfall': 0.1})
+        for columnar in (False, True):
+            # Pages are stored as json, see diff_pages.insert
+            pages = loads(dumps(diff_pages.paginate([diff], page_size=200,
+                                                    columnar=columnar)))
+            self.assertEqual([images] * 3, [p['images'] for p in pages])
+            # fetch() only reads the pages holding the requested items
+            diffs = diff_pages._merge(pages[1:2], ['Regular'])
+            self.assertEqual(images, diffs[0]['images'])
+            self.assertEqual({'waterfall': 0.1}, diffs[0]['sample_scores'])
+            self.assertEqual(items[200:400], list(diffs[0]['items']))
+
+
+class TestSaveStylesheet(unittest.TestCase):
+
+    def setUp(self):
+        self.families = {
+            'before': {'name': 'Roboto-before',
+                       'css_font_faces': ['@font-face{font-family: a;}']},
+            'after': {'name': 'Roboto-after',
+                      'css_font_faces': ['@font-face{font-family: b;}']},
+            'css_classes': ['.Regular{font-weight: 400;}'],
+        }
+
+    def test_save_stylesheet(self):
+        with tempfile.TemporaryDirectory() as stylesheets_dir, \
+                mock.patch.object(jobs, 'STYLESHEETS_DIR', stylesheets_dir):
+            path = jobs.save_stylesheet('1234', self.families)
+            css = jobs.families_stylesheet(self.families)
+            digest = hashlib.sha1(css.encode('utf-8')).hexdigest()[:12]
+            filename = '1234-{}.css'.format(digest)
+            self.assertEqual('stylesheets/' + filename, path)
+            with open(os.path.join(stylesheets_dir, filename)) as doc:
+                self.assertEqual(css, doc.read())
+
+            self.assertEqual(path, jobs.save_stylesheet('1234', self.families))
+            self.families['css_classes'].append('.Bold{font-weight: 700;}')
+            self.assertNotEqual(path,
+                                jobs.save_stylesheet('1234', self.families))
+            self.assertEqual(2, len(os.listdir(stylesheets_dir)))
+
+
+class StaleConnection:
+    """Connection to a database which has gone down"""
+
+    def _start(self, *args, **kwargs):
+        raise ReqlDriverError('Connection is closed.')
+
+    def reconnect(self, noreply_wait=True):
+        raise ReqlDriverError('Could not connect.')
+
+    def close(self, noreply_wait=True):
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = db.ConnectionPool('localhost', 28015, 'test', size=1,
+                                      timeout=0, check_interval=0)
+        self.pool._open = 1
+        self.pool._idle.put((StaleConnection(), 1))
+
+    def test_failed_reconnect_opens_new_connection(self):
+        new_conn = object()
+        self.pool._connect = lambda: new_conn
+        self.assertIs(new_conn, self.pool.acquire())
+        self.assertEqual(1, self.pool.stats()['open'])
+
+    def test_failed_reconnect_frees_slot(self):
+        def connect():
+            raise Exception("No database connection could be established.")
+        self.pool._connect = connect
+        with self.assertRaises(Exception):
+            self.pool.acquire()
+        self.assertEqual(0, self.pool.stats()['open'])
+
+
 if __name__ == '__main__':
     unittest.main()